@@ -0,0 +1,125 @@
+import re
+import json
+import time
+import argparse
+from pathlib import Path
+
+from pdf_to_md import CONVERSION_PROFILES, resolve_profile, build_converter, conversion_kwargs
+
+DIGITS_PATTERN = re.compile(r'\d[\d,]*')
+
+
+def expected_amounts(json_file):
+    """Digit strings of every amount in a variant's ground-truth cash-flow table"""
+    with open(json_file, encoding='utf-8') as f:
+        rows = json.load(f)
+    amounts = []
+    for row in rows[2:]:
+        for cell in row[1:]:
+            amounts.extend(m.replace(',', '') for m in DIGITS_PATTERN.findall(cell))
+    return amounts
+
+
+def table_amounts(document):
+    """Digit strings of every cell in the tables Docling recovered"""
+    found = set()
+    for table in document.tables:
+        frame = table.export_to_dataframe()
+        cells = [str(c) for c in frame.columns] + [str(v) for v in frame.values.ravel()]
+        for cell in cells:
+            found.update(m.replace(',', '') for m in DIGITS_PATTERN.findall(cell))
+    return found
+
+
+def benchmark_profile(name, pdf_files, json_dir):
+    """
+    Convert pdf_files with one profile and measure latency and table recovery.
+
+    Returns:
+        dict: profile, load_seconds, pages, ms_per_page, tables_per_file and
+        recovered (share of ground-truth amounts found in the recovered tables)
+    """
+    profile = resolve_profile(name)
+    start = time.perf_counter()
+    converter = build_converter(profile)
+    load_seconds = time.perf_counter() - start
+
+    pages = tables = expected = matched = 0
+    convert_seconds = 0.0
+    for pdf_file in pdf_files:
+        start = time.perf_counter()
+        result = converter.convert(str(pdf_file), **conversion_kwargs(profile))
+        convert_seconds += time.perf_counter() - start
+
+        pages += len(result.pages)
+        tables += len(result.document.tables)
+        json_file = Path(json_dir) / (pdf_file.stem + '.json')
+        if json_file.exists():
+            amounts = expected_amounts(json_file)
+            found = table_amounts(result.document)
+            expected += len(amounts)
+            matched += sum(1 for a in amounts if a in found)
+
+    return {
+        'profile': name,
+        'load_seconds': load_seconds,
+        'pages': pages,
+        'ms_per_page': 1000 * convert_seconds / pages if pages else 0.0,
+        'tables_per_file': tables / len(pdf_files),
+        'recovered': matched / expected if expected else 0.0,
+    }
+
+
+def run_benchmark(pdf_dir='pdf_out', json_dir='json_out', profiles=None, limit=20, min_recovered=1.0):
+    """
+    Compare conversion profiles on the scrambled PDFs and pick the cheapest good one.
+
+    Args:
+        pdf_dir (str): Directory holding the PDFs (default: 'pdf_out')
+        json_dir (str): Directory holding the ground-truth JSON (default: 'json_out')
+        profiles (list): Profile names to compare (default: all of CONVERSION_PROFILES)
+        limit (int): Number of PDFs converted per profile (default: 20)
+        min_recovered (float): Share of cash-flow amounts a profile must recover
+            to count as good enough (default: 1.0)
+
+    Returns:
+        list: One result dict per profile
+    """
+    pdf_files = sorted(Path(pdf_dir).glob('*.pdf'))[:limit]
+    if not pdf_files:
+        print(f"No PDF files found in {pdf_dir} directory")
+        return []
+
+    results = []
+    for name in profiles or list(CONVERSION_PROFILES):
+        print(f"Benchmarking {name} on {len(pdf_files)} PDFs...")
+        results.append(benchmark_profile(name, pdf_files, json_dir))
+
+    print(f"\n{'Profile':<24}{'Load s':>8}{'ms/page':>10}{'Tables/file':>13}{'Recovered':>11}")
+    for r in results:
+        print(f"{r['profile']:<24}{r['load_seconds']:>8.2f}{r['ms_per_page']:>10.1f}"
+              f"{r['tables_per_file']:>13.2f}{r['recovered']:>10.1%}")
+
+    good = [r for r in results if r['recovered'] >= min_recovered]
+    if good:
+        best = min(good, key=lambda r: r['ms_per_page'])
+        print(f"\nCheapest profile recovering the cash-flow table: {best['profile']}")
+    else:
+        print(f"\nNo profile recovered at least {min_recovered:.0%} of the cash-flow amounts")
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare Docling conversion profiles on the scrambled PDFs")
+    parser.add_argument('--pdf-dir', default='pdf_out', help="Directory holding the PDFs (default: pdf_out)")
+    parser.add_argument('--json-dir', default='json_out', help="Directory holding the ground truth (default: json_out)")
+    parser.add_argument('--profiles', nargs='+', choices=list(CONVERSION_PROFILES), default=None,
+                        help="Profiles to compare (default: all)")
+    parser.add_argument('--limit', type=int, default=20, help="PDFs converted per profile (default: 20)")
+    parser.add_argument('--min-recovered', type=float, default=1.0,
+                        help="Share of cash-flow amounts a profile must recover (default: 1.0)")
+    args = parser.parse_args()
+
+    run_benchmark(pdf_dir=args.pdf_dir, json_dir=args.json_dir, profiles=args.profiles,
+                  limit=args.limit, min_recovered=args.min_recovered)
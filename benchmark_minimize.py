@@ -0,0 +1,109 @@
+import time
+import argparse
+
+import scrambler
+from scrambler import load_compiled_document, iter_variants, render_pdf_html, load_html, TEMPLATE_CACHE_DIR
+
+
+def page_geometry(document):
+    """(box type, text, x, y, width, height) of every box on every page, rounded to 1/100 px"""
+    pages = []
+    for page in document.pages:
+        pages.append([(type(box).__name__, getattr(box, 'text', None),
+                       round(box.position_x, 2), round(box.position_y, 2),
+                       round(box.width or 0, 2), round(box.height or 0, 2))
+                      for box in page._page_box.descendants()])
+    return pages
+
+
+def visual_diff(full_document, minimized_document):
+    """
+    Compare two layouts of the same variant box by box.
+
+    Returns:
+        dict: same (bool), pages (full, minimized) and differing_boxes
+    """
+    full_pages = page_geometry(full_document)
+    minimized_pages = page_geometry(minimized_document)
+    differing = 0
+    for full_boxes, minimized_boxes in zip(full_pages, minimized_pages):
+        differing += sum(1 for a, b in zip(full_boxes, minimized_boxes) if a != b)
+        differing += abs(len(full_boxes) - len(minimized_boxes))
+    return {
+        'same': len(full_pages) == len(minimized_pages) and not differing,
+        'pages': (len(full_pages), len(minimized_pages)),
+        'differing_boxes': differing,
+    }
+
+
+def time_render(html_content, base_url):
+    """Lay out and write one PDF; returns (seconds, laid-out document)"""
+    start = time.perf_counter()
+    document = load_html(html_content, base_url).render(stylesheets=[scrambler._worker_stylesheet])
+    document.write_pdf()
+    return time.perf_counter() - start, document
+
+
+def run_benchmark(input_file='aapl_p33.html', count=10, seed=0, template_cache=TEMPLATE_CACHE_DIR):
+    """
+    Time PDF renders of the full and the minimized template and check they look the same.
+
+    Both versions of each variant are rendered back to back, in alternating
+    order, and their layouts compared box by box.
+
+    Args:
+        input_file (str): Input HTML file (default: 'aapl_p33.html')
+        count (int): Number of variants rendered (default: 10)
+        seed (int): Seed of the variants (default: 0)
+        template_cache (str): Compiled-template cache directory, or None
+
+    Returns:
+        dict: bytes and ms_per_pdf for 'full' and 'minimized', and visual_diff_failures
+    """
+    compiled = load_compiled_document(input_file, template_cache)
+    base_url = compiled['base_url']
+    scrambler.init_pdf_worker()
+
+    sizes = {'full': 0, 'minimized': 0}
+    seconds = {'full': 0.0, 'minimized': 0.0}
+    failures = 0
+    for n, variant in enumerate(iter_variants(compiled, count=count, seed=seed)):
+        html = {'full': variant['html'], 'minimized': render_pdf_html(compiled, variant['slot_values'])}
+        if n == 0:
+            # Warm up fonts and caches outside the measurement
+            time_render(html['full'], base_url)
+        documents = {}
+        for kind in (('full', 'minimized') if n % 2 == 0 else ('minimized', 'full')):
+            elapsed, documents[kind] = time_render(html[kind], base_url)
+            seconds[kind] += elapsed
+            sizes[kind] += len(html[kind].encode('utf-8'))
+
+        diff = visual_diff(documents['full'], documents['minimized'])
+        if not diff['same']:
+            failures += 1
+            print(f"Variant {variant['index']}: layouts differ (pages {diff['pages']}, "
+                  f"{diff['differing_boxes']} boxes)")
+
+    results = {kind: {'bytes': sizes[kind] / count, 'ms_per_pdf': 1000 * seconds[kind] / count}
+               for kind in seconds}
+    results['visual_diff_failures'] = failures
+
+    print(f"\n{'Template':<12}{'KB/doc':>10}{'ms/PDF':>10}")
+    for kind in ('full', 'minimized'):
+        print(f"{kind:<12}{results[kind]['bytes'] / 1024:>10.1f}{results[kind]['ms_per_pdf']:>10.1f}")
+    saved = results['full']['ms_per_pdf'] - results['minimized']['ms_per_pdf']
+    print(f"\nSaved {saved:.1f} ms per PDF ({saved / results['full']['ms_per_pdf']:.1%})")
+    print(f"Visual diff: {count - failures}/{count} variants identical")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark PDF renders of the minimized template")
+    parser.add_argument('--input', default='aapl_p33.html', help="Input HTML file (default: aapl_p33.html)")
+    parser.add_argument('--count', type=int, default=10, help="Variants rendered (default: 10)")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the variants (default: 0)")
+    parser.add_argument('--no-template-cache', action='store_true', help="Always re-parse the input")
+    args = parser.parse_args()
+
+    run_benchmark(input_file=args.input, count=args.count, seed=args.seed,
+                  template_cache=None if args.no_template_cache else TEMPLATE_CACHE_DIR)
@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
 # cleanup.py
 import sys
-from bs4 import BeautifulSoup, Tag
+import copy
+import heapq
+from pathlib import Path
+from bs4 import BeautifulSoup, Comment, NavigableString, Tag
+from lxml import etree
+
+def is_pagebreak(name, style):
+    return name == "hr" and "page-break-after:always" in (style or "")
 
 def split_on_pagebreaks(body_tag):
     pages, current = [], []
     for node in list(body_tag.children):
-        if isinstance(node, Tag) and node.name == "hr" and "page-break-after:always" in (node.get("style") or ""):
+        if isinstance(node, Tag) and is_pagebreak(node.name, node.get("style")):
             pages.append(current)
             current = []
         else:
@@ -15,21 +22,113 @@ def split_on_pagebreaks(body_tag):
         pages.append(current)
     return pages
 
-def collect_used_refs(root):
+def collect_used_refs(nodes):
+    # Walks the given nodes and their descendants
     used = set()
-    for tag in root.find_all(True):
+    tags = []
+    for node in nodes:
+        if isinstance(node, Tag):
+            tags.append(node)
+            tags.extend(node.find_all(True))
+    for tag in tags:
         for attr in ("contextref", "unitref", "footnoteref"):
             v = tag.get(attr)
             if v:
                 used.add(v)
     return used
 
-def prune_ix_header(ix_header, used_ids):
-    # Safely remove any element with an id that's not used
-    for el in list(ix_header.select('[id]')):
-        el_id = el.get('id')
-        if el_id and el_id not in used_ids:
-            el.decompose()
+def index_ix_header(ix_header):
+    """Index the hidden header once per filing.
+
+    Every child of a node on the path to an id-bearing element (contexts,
+    units, hidden facts) gets a record with its document-order position and
+    its parent's position. Records of id-bearing elements are indexed by id,
+    the rest form a fixed skeleton, so a page's header is built from set
+    lookups on the ids it uses instead of a pass over the whole header. The
+    header's own contextref/unitref/footnoteref values are collected here too:
+    the header is emitted with every page, so the contexts and units its
+    hidden facts point at are always in use.
+
+    Args:
+        ix_header: The ix:header tag, already detached from the body.
+
+    Returns:
+        dict: root (the header tag), skeleton (records without an id, in
+        document order), by_id (id -> records) and refs (set of ids
+        referenced from inside the header). A record is (position, parent
+        position, node, whether the node has id-bearing descendants); the
+        root has position 0.
+    """
+    mixed = set()
+    for el in ix_header.select('[id]'):
+        if not el.get('id'):
+            continue
+        for parent in el.parents:
+            if parent is ix_header:
+                break
+            mixed.add(id(parent))
+
+    skeleton = []
+    by_id = {}
+    position = 0
+
+    def walk(node, node_position):
+        nonlocal position
+        for child in node.children:
+            position += 1
+            record = (position, node_position, child, id(child) in mixed)
+            el_id = child.get('id') if isinstance(child, Tag) else None
+            if el_id:
+                by_id.setdefault(el_id, []).append(record)
+            else:
+                skeleton.append(record)
+            if record[3]:
+                walk(child, record[0])
+
+    walk(ix_header, 0)
+    return {
+        'root': ix_header,
+        'skeleton': skeleton,
+        'by_id': by_id,
+        'refs': collect_used_refs(ix_header.contents),
+    }
+
+def build_ix_header(soup, header_index, used_ids):
+    """Build a page's pruned copy of ix:header from the filing's header index.
+
+    Cost follows the ids the page uses plus the header's skeleton, not the
+    number of contexts and units in the header.
+
+    Args:
+        soup: Document the new header will belong to.
+        header_index: Result of index_ix_header().
+        used_ids: Ids referenced from the page.
+
+    Returns:
+        Tag: New ix:header holding only the referenced id-bearing elements.
+    """
+    by_id = header_index['by_id']
+    selected = []
+    for el_id in used_ids | header_index['refs']:
+        selected.extend(by_id.get(el_id, ()))
+    selected.sort(key=lambda record: record[0])
+
+    root = header_index['root']
+    clones = {0: soup.new_tag(root.name, attrs=dict(root.attrs))}
+    # Parents precede their children in document order, so each parent is
+    # cloned before its children arrive; children of an unused id-bearing
+    # element find no parent clone and are dropped with it
+    for position, parent_position, node, has_ids in heapq.merge(
+            header_index['skeleton'], selected, key=lambda record: record[0]):
+        parent = clones.get(parent_position)
+        if parent is None:
+            continue
+        if has_ids:
+            clones[position] = soup.new_tag(node.name, attrs=dict(node.attrs))
+            parent.append(clones[position])
+        else:
+            parent.append(copy.copy(node))
+    return clones[0]
 
 def add_hide_css(soup):
     style = soup.new_tag("style")
@@ -40,47 +139,233 @@ ix\:header, ix\:header * { display:none !important; }
 """
     soup.head.append(style)
 
-
-def main():
-    if len(sys.argv) != 4:
-        print("Usage: python cleanup.py input.html output.html PAGE_NO", file=sys.stderr)
-        sys.exit(1)
-
-    in_path, out_path, page_str = sys.argv[1:]
-    page_no = int(page_str)
-
+def load_filing(in_path):
     with open(in_path, encoding="windows-1252", errors="replace") as f:
         soup = BeautifulSoup(f.read(), "lxml")
-
-    body = soup.body
-    if not body:
+    if not soup.body:
         raise SystemExit("No <body> tag found.")
+    return soup
 
+def prepare_filing(in_path):
+    # Parse once; take the header out of the body so no page carries the original
+    soup = load_filing(in_path)
+    head = soup.html.head if soup.html else None
     ix_header = soup.find("ix:header")
+    header_index = None
+    if ix_header:
+        ix_header.extract()
+        header_index = index_ix_header(ix_header)
+    pages = split_on_pagebreaks(soup.body)
+    return head, header_index, pages
 
-    pages = split_on_pagebreaks(body)
-    if not (1 <= page_no <= len(pages)):
-        raise SystemExit(f"Page {page_no} out of range (1..{len(pages)}).")
-    page_nodes = pages[page_no - 1]
-
-    # Build new doc
+def build_page_document(head, header_index, page_nodes):
+    # Build new doc from the page's nodes, its own head and its own ix:header
     new = BeautifulSoup("<html><head></head><body></body></html>", "lxml")
-    if soup.html and soup.html.head:
-        new.html.head.replace_with(soup.html.head)
+    if head:
+        new.html.head.replace_with(head)
 
     add_hide_css(new)
 
-    if ix_header:
+    if header_index:
+        used_ids = collect_used_refs(page_nodes)
         wrapper = new.new_tag("div", style="display:none")
-        wrapper.append(ix_header)
+        wrapper.append(build_ix_header(new, header_index, used_ids))
         new.body.append(wrapper)
 
     for n in page_nodes:
         new.body.append(n)
 
-    if ix_header:
-        used_ids = collect_used_refs(new.body)
-        prune_ix_header(ix_header, used_ids)
+    return new
+
+def parse_pages(spec, page_count=None):
+    # "all", or a comma-separated list of pages and ranges such as "1,3,30-35".
+    # Without a page count (streaming), "all" is None and ranges are unchecked.
+    if spec == "all":
+        return list(range(1, page_count + 1)) if page_count is not None else None
+    pages = []
+    for part in spec.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            pages.extend(range(int(first), int(last) + 1))
+        else:
+            pages.append(int(part))
+    for page_no in pages:
+        if not (1 <= page_no <= (page_count or page_no)):
+            raise SystemExit(f"Page {page_no} out of range (1..{page_count}).")
+    return pages
+
+def split_filing(in_path, out_dir, page_spec="all"):
+    # Parse and split the filing once, then write every requested page
+    head, header_index, pages = prepare_filing(in_path)
+    page_numbers = parse_pages(page_spec, len(pages))
+
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    stem = Path(in_path).stem
+    out_paths = []
+    for page_no in page_numbers:
+        new = build_page_document(
+            copy.copy(head) if head else None,
+            header_index,
+            pages[page_no - 1],
+        )
+        out_path = Path(out_dir) / f"{stem}_p{page_no}.html"
+        with open(out_path, "w", encoding="utf-8") as f:
+            f.write(str(new))
+        out_paths.append(out_path)
+        print(f"Saved {out_path} (page {page_no}/{len(pages)}).")
+    return out_paths
+
+
+def _to_soup_nodes(parts):
+    # Re-create finished lxml body children (and body-level text) as soup nodes
+    nodes = []
+    for part in parts:
+        if isinstance(part, str):
+            nodes.append(NavigableString(part))
+        elif not isinstance(part.tag, str):
+            nodes.append(Comment(part.text or ""))
+        else:
+            html = etree.tostring(part, encoding="unicode", method="html", with_tail=False)
+            nodes.extend(BeautifulSoup(html, "lxml").body.contents)
+    return nodes
+
+def _head_to_soup(head_el):
+    html = etree.tostring(head_el, encoding="unicode", method="html", with_tail=False)
+    return BeautifulSoup(f"<html>{html}</html>", "lxml").html.head
+
+def stream_pages(in_path, chunk_size=1 << 16):
+    """Split a filing into pages without building the whole document tree.
+
+    The file is fed to an incremental lxml parser chunk by chunk. Each body
+    child is converted once its tail text is known and then dropped from the
+    lxml tree, and a page is yielded as soon as its page-break hr closes it,
+    so peak memory follows the largest page rather than the filing. Only the
+    head and the indexed ix:header stay resident. Pages read before the
+    ix:header turns up (normally none; it sits at the top of the body) are
+    held back until it does.
+
+    Args:
+        in_path: Path to the filing.
+        chunk_size: Characters fed to the parser per read.
+
+    Yields:
+        tuple: (head, header_index, page_nodes) per page, in order. head is a
+        fresh copy for each page.
+    """
+    # Comments and PIs are body children too; their tails are page text
+    parser = etree.HTMLPullParser(events=("start", "end", "comment", "pi"))
+    head = None
+    header_index = None
+    body = None
+    pending = None
+    current = []
+    held = []
+
+    def finish(el):
+        # el's tail is only known once its next sibling starts or the body ends
+        if is_pagebreak(el.tag, el.get("style")):
+            yield from close_page()
+        else:
+            current.append(el)
+        if el.tail:
+            current.append(el.tail)
+        body.remove(el)
+
+    def close_page():
+        nonlocal header_index, current
+        parts = current
+        current = []
+        nodes = _to_soup_nodes(parts)
+        if header_index is None:
+            for n in nodes:
+                if isinstance(n, Tag):
+                    ix_header = n if n.name == "ix:header" else n.find("ix:header")
+                    if ix_header:
+                        ix_header.extract()
+                        header_index = index_ix_header(ix_header)
+                        break
+        held.append(nodes)
+        if header_index is None:
+            return []
+        ready = [(copy.copy(head) if head else None, header_index, page) for page in held]
+        held.clear()
+        return ready
+
+    with open(in_path, encoding="windows-1252", errors="replace") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if chunk:
+                parser.feed(chunk)
+            else:
+                parser.close()
+            for event, el in parser.read_events():
+                if event == "end" and el.tag == "head":
+                    head = _head_to_soup(el)
+                elif event == "start" and el.tag == "body" and body is None:
+                    body = el
+                elif event in ("start", "comment", "pi") and body is not None and el.getparent() is body:
+                    if pending is not None:
+                        yield from finish(pending)
+                    elif body.text:
+                        current.append(body.text)
+                    pending = el
+                elif event == "end" and el is body and pending is not None:
+                    yield from finish(pending)
+                    pending = None
+            if not chunk:
+                break
+
+    if body is None:
+        raise SystemExit("No <body> tag found.")
+    if current:
+        yield from close_page()
+    for page in held:
+        yield (copy.copy(head) if head else None, None, page)
+
+def stream_split_filing(in_path, out_dir, page_spec="all"):
+    # Batch mode for large filings: write pages as the parser reaches them
+    wanted = parse_pages(page_spec)
+    last = max(wanted) if wanted else None
+    wanted = set(wanted) if wanted else None
+
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    stem = Path(in_path).stem
+    out_paths = []
+    for page_no, (head, header_index, page_nodes) in enumerate(stream_pages(in_path), 1):
+        if wanted is None or page_no in wanted:
+            new = build_page_document(head, header_index, page_nodes)
+            out_path = Path(out_dir) / f"{stem}_p{page_no}.html"
+            with open(out_path, "w", encoding="utf-8") as f:
+                f.write(str(new))
+            out_paths.append(out_path)
+            print(f"Saved {out_path} (page {page_no}).")
+        if last is not None and page_no >= last:
+            break
+    return out_paths
+
+def main():
+    if len(sys.argv) in (4, 5) and sys.argv[1] in ("--batch", "--stream"):
+        in_path, out_dir = sys.argv[2:4]
+        page_spec = sys.argv[4] if len(sys.argv) == 5 else "all"
+        if sys.argv[1] == "--stream":
+            stream_split_filing(in_path, out_dir, page_spec)
+        else:
+            split_filing(in_path, out_dir, page_spec)
+        return
+
+    if len(sys.argv) != 4:
+        print("Usage: python cleanup.py input.html output.html PAGE_NO", file=sys.stderr)
+        print("       python cleanup.py --batch input.html OUTPUT_DIR [PAGES|all]", file=sys.stderr)
+        print("       python cleanup.py --stream input.html OUTPUT_DIR [PAGES|all]", file=sys.stderr)
+        sys.exit(1)
+
+    in_path, out_path, page_str = sys.argv[1:]
+    page_no = int(page_str)
+
+    head, header_index, pages = prepare_filing(in_path)
+    if not (1 <= page_no <= len(pages)):
+        raise SystemExit(f"Page {page_no} out of range (1..{len(pages)}).")
+    new = build_page_document(head, header_index, pages[page_no - 1])
 
     with open(out_path, "w", encoding="utf-8") as f:
         f.write(str(new))
@@ -1,7 +1,12 @@
 # from reducto.reducto import Reducto
 from pathlib import Path
-from docling.document_converter import DocumentConverter
+from concurrent.futures import ProcessPoolExecutor
+from importlib import metadata
+import hashlib
+import json
+import sqlite3
 import os
+import argparse
 
 # need API key
 # def reducto_to_md():
@@ -17,42 +22,307 @@ import os
 #     )
 #     return result
 
+# Conversion profiles: Docling pipeline settings plus an optional page range.
+# Scrambled PDFs come out of WeasyPrint with a real text layer, so the
+# born-digital profiles switch OCR off; they differ in how tables are recovered.
+CONVERSION_PROFILES = {
+    'default': {},
+    'born_digital': {'do_ocr': False, 'table_mode': 'fast'},
+    'born_digital_accurate': {'do_ocr': False, 'table_mode': 'accurate'},
+    'text_only': {'do_ocr': False, 'do_table_structure': False},
+}
+
+# Converter kept warm for the life of the process (or pool worker)
+_worker_converter = None
+_worker_profile = {}
+
+
+def resolve_profile(profile):
+    """Return the settings dict for a profile name (or pass a settings dict through)"""
+    if profile is None:
+        return {}
+    if isinstance(profile, str):
+        if profile not in CONVERSION_PROFILES:
+            raise ValueError(f"Unknown conversion profile {profile!r}; choose from {', '.join(CONVERSION_PROFILES)}")
+        return dict(CONVERSION_PROFILES[profile])
+    return dict(profile)
+
+
+def build_converter(profile):
+    """
+    Build a DocumentConverter for a profile's settings.
+
+    Args:
+        profile (dict): do_ocr, do_table_structure (bools), table_mode ('fast' or
+            'accurate') and page_range ((first, last), 1-based); all optional.
+            An empty profile gives Docling's stock converter.
+
+    Returns:
+        DocumentConverter
+    """
+    # Docling is imported on first use so importing this module stays cheap
+    from docling.document_converter import DocumentConverter, PdfFormatOption
+    pipeline_keys = ('do_ocr', 'do_table_structure', 'table_mode')
+    if not any(key in profile for key in pipeline_keys):
+        return DocumentConverter()
+
+    from docling.datamodel.base_models import InputFormat
+    from docling.datamodel.pipeline_options import PdfPipelineOptions, TableFormerMode
+    pipeline_options = PdfPipelineOptions()
+    if 'do_ocr' in profile:
+        pipeline_options.do_ocr = profile['do_ocr']
+    if 'do_table_structure' in profile:
+        pipeline_options.do_table_structure = profile['do_table_structure']
+    if 'table_mode' in profile:
+        pipeline_options.table_structure_options.mode = TableFormerMode(profile['table_mode'])
+    return DocumentConverter(format_options={InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options)})
+
+
+def conversion_kwargs(profile):
+    # Per-call options: Docling limits pages at convert time, not in the pipeline
+    if profile.get('page_range'):
+        return {'page_range': tuple(profile['page_range'])}
+    return {}
+
+
+def init_docling_worker(profile=None):
+    """Build the DocumentConverter once so every conversion in this process reuses its loaded models"""
+    global _worker_converter, _worker_profile
+    _worker_profile = resolve_profile(profile)
+    _worker_converter = build_converter(_worker_profile)
+
+
 def docling_to_md(pdf_path):
-    converter = DocumentConverter()
-    result = converter.convert(pdf_path)
+    if _worker_converter is None:
+        init_docling_worker()
+    result = _worker_converter.convert(pdf_path, **conversion_kwargs(_worker_profile))
     return result.document.export_to_markdown()
 
-def process_all_pdfs():
+
+def write_markdown(pdf_file, markdown_content, output_dir):
+    # Create output filename (change .pdf to .md)
+    output_path = Path(output_dir) / (Path(pdf_file).stem + ".md")
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write(markdown_content)
+    return output_path
+
+
+def converter_fingerprint(options=None):
+    """Identify the converter build and settings, so cached Markdown is reused only when both match"""
+    try:
+        version = metadata.version("docling")
+    except metadata.PackageNotFoundError:
+        version = "unknown"
+    return f"docling {version} " + json.dumps(options or {}, sort_keys=True)
+
+
+def open_conversion_cache(cache_file, check_same_thread=True):
+    """
+    Open (creating if needed) the SQLite cache of converted Markdown keyed by PDF hash and converter.
+
+    Pass check_same_thread=False to share the connection between threads that
+    serialize their access to it.
+    """
+    connection = sqlite3.connect(cache_file, check_same_thread=check_same_thread)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS conversions ("
+        "pdf_sha256 TEXT NOT NULL, converter TEXT NOT NULL, markdown TEXT NOT NULL, "
+        "PRIMARY KEY (pdf_sha256, converter))"
+    )
+    return connection
+
+
+def cached_markdown(cache, pdf_hash, fingerprint):
+    """Markdown cached for a PDF hash and converter fingerprint, or None"""
+    row = cache.execute(
+        "SELECT markdown FROM conversions WHERE pdf_sha256 = ? AND converter = ?",
+        (pdf_hash, fingerprint),
+    ).fetchone()
+    return row[0] if row is not None else None
+
+
+def store_markdown(cache, pdf_hash, fingerprint, markdown_content):
+    cache.execute(
+        "INSERT OR REPLACE INTO conversions VALUES (?, ?, ?)",
+        (pdf_hash, fingerprint, markdown_content),
+    )
+
+
+def hash_pdf(pdf_file):
+    digest = hashlib.sha256()
+    with open(pdf_file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def convert_pdf_batch(pdf_files):
+    """
+    Convert one batch of PDFs with the process's warm converter.
+
+    The batch goes through Docling's convert_all; if that raises, the files are
+    retried one at a time so a single bad PDF only fails itself.
+
+    Returns:
+        list: (pdf_file, markdown or None, error message or None) per PDF
+    """
+    from docling.datamodel.base_models import ConversionStatus
+    outcomes = []
+    try:
+        results = _worker_converter.convert_all(pdf_files, raises_on_error=False,
+                                                **conversion_kwargs(_worker_profile))
+        for pdf_file, result in zip(pdf_files, results):
+            if result.status in (ConversionStatus.SUCCESS, ConversionStatus.PARTIAL_SUCCESS):
+                outcomes.append((pdf_file, result.document.export_to_markdown(), None))
+            else:
+                errors = "; ".join(e.error_message for e in result.errors)
+                outcomes.append((pdf_file, None, errors or result.status.name))
+    except Exception:
+        done = {outcome[0] for outcome in outcomes}
+        for pdf_file in pdf_files:
+            if pdf_file in done:
+                continue
+            try:
+                outcomes.append((pdf_file, docling_to_md(pdf_file), None))
+            except Exception as e:
+                outcomes.append((pdf_file, None, str(e)))
+    return outcomes
+
+
+def process_all_pdfs(pdf_dir="pdf_out", output_dir="docling_md", workers=1, batch_size=8,
+                     cache_file=None, profile="default", use_cache=True):
+    """
+    Convert every PDF in pdf_dir to Markdown in output_dir.
+
+    PDFs whose content hash and converter fingerprint are already in the cache
+    are not converted again; their Markdown is restored from the cache if the
+    output file is missing or stale. The rest go to worker processes that each
+    build one DocumentConverter and convert their share of the queue in
+    batches. Failures are reported per file and do not stop the run.
+
+    Args:
+        pdf_dir (str): Directory holding the PDFs (default: "pdf_out")
+        output_dir (str): Directory for the Markdown files (default: "docling_md")
+        workers (int): Number of worker processes; 1 converts in this process (default: 1)
+        batch_size (int): PDFs handed to a worker at a time (default: 8)
+        cache_file (str): SQLite conversion cache (default: None, conversion_cache.sqlite
+            in output_dir)
+        profile (str or dict): Name in CONVERSION_PROFILES or a settings dict
+            (default: "default", Docling's stock pipeline)
+        use_cache (bool): Look up and store conversions in the cache; False always
+            converts (default: True)
+
+    Returns:
+        dict: converted (list of PDF paths), failed (dict of PDF path -> error),
+        cache_hits and cache_misses
+    """
     # Create docling_md directory if it doesn't exist
-    os.makedirs("docling_md", exist_ok=True)
-    
+    os.makedirs(output_dir, exist_ok=True)
+
     # Get all PDF files from pdf_out directory
-    pdf_dir = Path("pdf_out")
-    pdf_files = list(pdf_dir.glob("*.pdf"))
-    
+    pdf_files = sorted(str(p) for p in Path(pdf_dir).glob("*.pdf"))
+
     if not pdf_files:
-        print("No PDF files found in pdf_out directory")
-        return
-    
+        print(f"No PDF files found in {pdf_dir} directory")
+        return {'converted': [], 'failed': {}, 'cache_hits': 0, 'cache_misses': 0}
+
     print(f"Found {len(pdf_files)} PDF files to process...")
-    
-    for pdf_file in pdf_files:
-        print(f"Processing {pdf_file.name}...")
-        
-        # Convert PDF to markdown
-        markdown_content = docling_to_md(str(pdf_file))
-        
-        # Create output filename (change .pdf to .md)
-        output_filename = pdf_file.stem + ".md"
-        output_path = Path("docling_md") / output_filename
-        
-        # Write markdown to file
-        with open(output_path, "w", encoding="utf-8") as f:
-            f.write(markdown_content)
-        
-        print(f"Saved {output_filename}")
-    
-    print(f"All done! Processed {len(pdf_files)} files.")
-
-# Run the batch processing
-process_all_pdfs()
\ No newline at end of file
+
+    profile = resolve_profile(profile)
+    converted = []
+    failed = {}
+    cache = None
+    pending = pdf_files
+    if use_cache:
+        if cache_file is None:
+            cache_file = os.path.join(output_dir, 'conversion_cache.sqlite')
+        Path(cache_file).parent.mkdir(parents=True, exist_ok=True)
+        cache = open_conversion_cache(cache_file)
+        fingerprint = converter_fingerprint(profile)
+        pdf_hashes = {pdf_file: hash_pdf(pdf_file) for pdf_file in pdf_files}
+        pending = []
+        for pdf_file in pdf_files:
+            markdown_content = cached_markdown(cache, pdf_hashes[pdf_file], fingerprint)
+            if markdown_content is None:
+                pending.append(pdf_file)
+                continue
+            output_path = Path(output_dir) / (Path(pdf_file).stem + ".md")
+            if not output_path.exists() or output_path.read_text(encoding="utf-8") != markdown_content:
+                write_markdown(pdf_file, markdown_content, output_dir)
+            converted.append(pdf_file)
+        print(f"Cache: {len(pdf_files) - len(pending)} hits, {len(pending)} misses")
+
+    jobs = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    pool = None
+    if not jobs:
+        results = []
+    elif workers <= 1:
+        init_docling_worker(profile)
+        results = map(convert_pdf_batch, jobs)
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=init_docling_worker, initargs=(profile,))
+        results = pool.map(convert_pdf_batch, jobs)
+
+    try:
+        for outcomes in results:
+            for pdf_file, markdown_content, error in outcomes:
+                if error is None:
+                    output_path = write_markdown(pdf_file, markdown_content, output_dir)
+                    if cache is not None:
+                        store_markdown(cache, pdf_hashes[pdf_file], fingerprint, markdown_content)
+                    converted.append(pdf_file)
+                    print(f"Saved {output_path.name}")
+                else:
+                    failed[pdf_file] = error
+                    print(f"Error converting {pdf_file}: {error}")
+            if cache is not None:
+                cache.commit()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if cache is not None:
+            cache.close()
+
+    print(f"All done! Converted {len(converted)} of {len(pdf_files)} files.")
+    if failed:
+        print(f"{len(failed)} files failed: {', '.join(Path(p).name for p in failed)}")
+
+    return {
+        'converted': converted,
+        'failed': failed,
+        'cache_hits': len(pdf_files) - len(pending),
+        'cache_misses': len(pending),
+    }
+
+
+def parse_page_range(text):
+    """Parse a page range such as '1-3' into (1, 3)"""
+    try:
+        first, last = (int(part) for part in text.split('-'))
+        if not 1 <= first <= last:
+            raise ValueError(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected FIRST-LAST with 1 <= FIRST <= LAST, got '{text}'")
+    return first, last
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert scrambled PDFs to Markdown with Docling")
+    parser.add_argument('--pdf-dir', default='pdf_out', help="Directory holding the PDFs (default: pdf_out)")
+    parser.add_argument('--output-dir', default='docling_md', help="Directory for the Markdown (default: docling_md)")
+    parser.add_argument('--workers', type=int, default=1, help="Converter processes (default: 1)")
+    parser.add_argument('--batch-size', type=int, default=8, help="PDFs handed to a worker at a time (default: 8)")
+    parser.add_argument('--no-cache', action='store_true', help="Convert every PDF, ignoring the conversion cache")
+    parser.add_argument('--profile', choices=list(CONVERSION_PROFILES), default='default',
+                        help="Conversion profile (default: default)")
+    parser.add_argument('--pages', type=parse_page_range, default=None, metavar='FIRST-LAST',
+                        help="Convert only this page range of each PDF (e.g. 1-1)")
+    args = parser.parse_args()
+
+    profile = resolve_profile(args.profile)
+    if args.pages:
+        profile['page_range'] = args.pages
+
+    # Run the batch processing
+    process_all_pdfs(pdf_dir=args.pdf_dir, output_dir=args.output_dir, workers=args.workers,
+                     batch_size=args.batch_size, profile=profile,
+                     use_cache=not args.no_cache)
\ No newline at end of file
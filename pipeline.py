@@ -0,0 +1,305 @@
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter
+
+from scrambler import (load_compiled_document, iter_variants, render_pdf_html, init_pdf_worker, render_pdf_job,
+                       format_fetch_counts, TEMPLATE_CACHE_DIR)
+from pdf_to_md import (CONVERSION_PROFILES, resolve_profile, init_docling_worker, convert_pdf_batch, write_markdown,
+                       open_conversion_cache, converter_fingerprint, cached_markdown, store_markdown, hash_pdf,
+                       parse_page_range)
+
+# Marks the end of a stage's input; every stage passes one on once all its threads are done
+STOP = None
+
+
+def new_stage(name, work, workers=1):
+    """A pipeline stage: work(item) returns the item for the next stage, or None to drop it"""
+    return {
+        'name': name,
+        'work': work,
+        'workers': workers,
+        'items': 0,
+        'errors': 0,
+        'busy': 0.0,
+        'first': None,
+        'last': None,
+        'max_queued': 0,
+        'lock': threading.Lock(),
+    }
+
+
+def run_stage(stage, inbox, outbox):
+    """
+    Start the threads of one stage.
+
+    Each thread takes an item from inbox, runs the stage's work on it and puts the
+    result on outbox. Both queues are bounded, so a thread blocks on a full outbox
+    until the next stage catches up and memory stays flat however slow that stage is.
+    Errors are reported per item and do not stop the pipeline.
+
+    Args:
+        stage (dict): Result of new_stage
+        inbox (queue.Queue): Items for this stage, ended by STOP
+        outbox (queue.Queue): Queue of the next stage, or None for the last stage
+
+    Returns:
+        list: The started threads
+    """
+    running = [stage['workers']]
+
+    def worker():
+        while True:
+            item = inbox.get()
+            if item is STOP:
+                # Leave the marker for the stage's other threads; the last one out passes it on
+                inbox.put(STOP)
+                with stage['lock']:
+                    running[0] -= 1
+                    last_out = running[0] == 0
+                if last_out and outbox is not None:
+                    outbox.put(STOP)
+                return
+
+            start = time.perf_counter()
+            try:
+                result = stage['work'](item)
+            except Exception as e:
+                result = None
+                print(f"[{stage['name']}] Error on variant {item['index']}: {e}")
+            end = time.perf_counter()
+
+            with stage['lock']:
+                stage['items'] += 1
+                stage['errors'] += result is None
+                stage['busy'] += end - start
+                stage['first'] = start if stage['first'] is None else min(stage['first'], start)
+                stage['last'] = end if stage['last'] is None else max(stage['last'], end)
+                stage['max_queued'] = max(stage['max_queued'], inbox.qsize())
+            if result is not None and outbox is not None:
+                outbox.put(result)
+
+    threads = [threading.Thread(target=worker, name=f"{stage['name']}-{n}", daemon=True)
+               for n in range(stage['workers'])]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def print_throughput(stages, wall_seconds):
+    """Print items, busy time, throughput and peak input queue of every stage"""
+    print(f"\n{'Stage':<10}{'Workers':>8}{'Items':>7}{'Errors':>8}{'Busy s':>9}{'Items/s':>9}"
+          f"{'Util':>7}{'Max queued':>12}")
+    for stage in stages:
+        active = (stage['last'] - stage['first']) if stage['items'] else 0.0
+        rate = stage['items'] / active if active else 0.0
+        utilization = stage['busy'] / (wall_seconds * stage['workers']) if wall_seconds else 0.0
+        print(f"{stage['name']:<10}{stage['workers']:>8}{stage['items']:>7}{stage['errors']:>8}"
+              f"{stage['busy']:>9.2f}{rate:>9.1f}{utilization:>7.0%}{stage['max_queued']:>12}")
+    slowest = max(stages, key=lambda stage: stage['busy'] / stage['workers'])
+    print(f"\nWall time {wall_seconds:.2f} s; slowest stage alone ({slowest['name']}) "
+          f"{slowest['busy'] / slowest['workers']:.2f} s; all stages in sequence "
+          f"{sum(stage['busy'] / stage['workers'] for stage in stages):.2f} s")
+
+
+def run_pipeline(generate_file_count=10, input_file='aapl_p33.html', seed=None, output_dir=None,
+                 write_html=True, write_pdf=True, write_markdown_files=True, pdf_workers=1, md_workers=1,
+                 io_workers=1, queue_size=8, profile='default', pages=None, use_conversion_cache=True,
+                 template_cache=None):
+    """
+    Run scramble -> HTML -> JSON -> PDF -> Markdown as concurrent stages.
+
+    Variants stream through bounded queues: while one variant is converted by
+    Docling the next is being rendered by WeasyPrint and later ones are being
+    scrambled and written, so wall time approaches that of the slowest stage
+    instead of the sum of all of them. PDF rendering and Docling conversion run
+    in their own warm process pools; each stage's threads keep at most one job
+    per worker in flight, so a slow stage backs up into its bounded queue and
+    stalls the stages before it rather than growing memory.
+
+    Args:
+        generate_file_count (int): Number of variants (default: 10)
+        input_file (str): Input HTML file (default: 'aapl_p33.html')
+        seed (int): Seed for reproducible output (default: None)
+        output_dir (str): Directory for html_out/json_out/pdf_out/docling_md
+            (default: the current directory)
+        write_html (bool): Write html_out files (default: True)
+        write_pdf (bool): Render pdf_out files (default: True)
+        write_markdown_files (bool): Convert each PDF to docling_md (default: True)
+        pdf_workers (int): WeasyPrint processes (default: 1)
+        md_workers (int): Docling processes (default: 1)
+        io_workers (int): Threads writing HTML and JSON files, per stage (default: 1)
+        queue_size (int): Capacity of each queue between stages (default: 8)
+        profile (str or dict): Name in CONVERSION_PROFILES or a settings dict (default: 'default')
+        pages (tuple): (first, last) 1-based page range converted per PDF (default: all pages)
+        use_conversion_cache (bool): Reuse and record Markdown in docling_md/conversion_cache.sqlite,
+            keyed by PDF hash and converter fingerprint as in process_all_pdfs (default: True)
+        template_cache (str): Compiled-template cache directory, or None to always
+            compile (default: None; the CLI uses TEMPLATE_CACHE_DIR inside output_dir)
+
+    Returns:
+        dict: wall_seconds and one stats dict per stage (name, workers, items,
+              errors, busy seconds, max_queued)
+    """
+    def output_path(*parts):
+        return os.path.join(output_dir, *parts) if output_dir else os.path.join(*parts)
+
+    compiled = load_compiled_document(input_file, template_cache)
+    base_url = compiled['base_url']
+    write_markdown_files = write_markdown_files and write_pdf
+
+    def write_html_file(item):
+        with open(output_path('html_out', f"{item['index']}.html"), 'w', encoding='utf-8') as f:
+            f.write(item['html'])
+        return item
+
+    def write_json_file(item):
+        with open(output_path('json_out', f"{item['index']}.json"), 'w', encoding='utf-8') as f:
+            json.dump(item['json'], f, indent=2, ensure_ascii=False)
+        # Later stages only need the PDF input
+        return {'index': item['index'], 'slot_values': item['slot_values']}
+
+    fetch_counts = Counter()
+    fetch_lock = threading.Lock()
+
+    def render_pdf(item):
+        pdf_file = output_path('pdf_out', f"{item['index']}.pdf")
+        job = (render_pdf_html(compiled, item['slot_values']), pdf_file, base_url)
+        pdf_file, error, counts = pdf_pool.submit(render_pdf_job, job).result()
+        with fetch_lock:
+            fetch_counts.update(counts)
+        if error is not None:
+            raise RuntimeError(error)
+        return {'index': item['index'], 'pdf_file': pdf_file}
+
+    profile = resolve_profile(profile)
+    if pages:
+        profile['page_range'] = tuple(pages)
+    cache = None
+    cache_stats = Counter()
+    cache_lock = threading.Lock()
+
+    def convert_markdown(item):
+        pdf_file = item['pdf_file']
+        if cache is not None:
+            pdf_hash = hash_pdf(pdf_file)
+            with cache_lock:
+                markdown_content = cached_markdown(cache, pdf_hash, fingerprint)
+                cache_stats['hits' if markdown_content is not None else 'misses'] += 1
+            if markdown_content is not None:
+                write_markdown(pdf_file, markdown_content, output_path('docling_md'))
+                return item
+
+        (pdf_file, markdown_content, error), = md_pool.submit(convert_pdf_batch, [pdf_file]).result()
+        if error is not None:
+            raise RuntimeError(error)
+        write_markdown(pdf_file, markdown_content, output_path('docling_md'))
+        if cache is not None:
+            with cache_lock:
+                store_markdown(cache, pdf_hash, fingerprint, markdown_content)
+                cache.commit()
+        return item
+
+    stages = []
+    if write_html:
+        os.makedirs(output_path('html_out'), exist_ok=True)
+        stages.append(new_stage('html', write_html_file, io_workers))
+    os.makedirs(output_path('json_out'), exist_ok=True)
+    stages.append(new_stage('json', write_json_file, io_workers))
+    pdf_pool = md_pool = None
+    if write_pdf:
+        os.makedirs(output_path('pdf_out'), exist_ok=True)
+        pdf_pool = ProcessPoolExecutor(max_workers=pdf_workers, initializer=init_pdf_worker)
+        stages.append(new_stage('pdf', render_pdf, pdf_workers))
+    if write_markdown_files:
+        os.makedirs(output_path('docling_md'), exist_ok=True)
+        md_pool = ProcessPoolExecutor(max_workers=md_workers, initializer=init_docling_worker,
+                                      initargs=(profile,))
+        if use_conversion_cache:
+            # Shared by the stage's threads, which take cache_lock around every use
+            cache = open_conversion_cache(output_path('docling_md', 'conversion_cache.sqlite'),
+                                          check_same_thread=False)
+            fingerprint = converter_fingerprint(profile)
+        stages.append(new_stage('markdown', convert_markdown, md_workers))
+
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    scramble = new_stage('scramble', None)
+    print(f"Running {' -> '.join(['scramble'] + [stage['name'] for stage in stages])} "
+          f"for {generate_file_count} variants...")
+
+    start = time.perf_counter()
+    try:
+        threads = []
+        for stage, inbox, outbox in zip(stages, queues, queues[1:] + [None]):
+            threads.extend(run_stage(stage, inbox, outbox))
+
+        # The scramble stage feeds the first queue from this thread
+        variants = iter_variants(compiled, count=generate_file_count, seed=seed)
+        while True:
+            item_start = time.perf_counter()
+            variant = next(variants, None)
+            if variant is None:
+                break
+            item_end = time.perf_counter()
+            scramble['items'] += 1
+            scramble['busy'] += item_end - item_start
+            scramble['first'] = item_start if scramble['first'] is None else scramble['first']
+            scramble['last'] = item_end
+            queues[0].put({key: variant[key] for key in ('index', 'html', 'json', 'slot_values')})
+        queues[0].put(STOP)
+
+        for thread in threads:
+            thread.join()
+    finally:
+        for pool in (pdf_pool, md_pool):
+            if pool is not None:
+                pool.shutdown()
+        if cache is not None:
+            cache.close()
+    wall_seconds = time.perf_counter() - start
+
+    stages.insert(0, scramble)
+    print_throughput(stages, wall_seconds)
+    if write_pdf:
+        print(f"PDF assets: {format_fetch_counts(fetch_counts)}")
+    if cache is not None:
+        print(f"Conversion cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+
+    return {
+        'wall_seconds': wall_seconds,
+        'stages': [{key: stage[key] for key in ('name', 'workers', 'items', 'errors', 'busy', 'max_queued')}
+                   for stage in stages],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Scramble, render and convert variants as a concurrent pipeline")
+    parser.add_argument('--count', type=int, default=10, help="Number of variants (default: 10)")
+    parser.add_argument('--input', default='aapl_p33.html', help="Input HTML file (default: aapl_p33.html)")
+    parser.add_argument('--seed', type=int, default=None, help="Seed for reproducible output")
+    parser.add_argument('--output-dir', default=None, help="Directory for html_out/json_out/pdf_out/docling_md")
+    parser.add_argument('--pdf-workers', type=int, default=1, help="WeasyPrint processes (default: 1)")
+    parser.add_argument('--md-workers', type=int, default=1, help="Docling processes (default: 1)")
+    parser.add_argument('--io-workers', type=int, default=1, help="Threads writing HTML/JSON per stage (default: 1)")
+    parser.add_argument('--queue-size', type=int, default=8, help="Capacity of each queue between stages (default: 8)")
+    parser.add_argument('--profile', choices=list(CONVERSION_PROFILES), default='default',
+                        help="Docling conversion profile (default: default)")
+    parser.add_argument('--pages', type=parse_page_range, default=None, metavar='FIRST-LAST',
+                        help="Convert only this page range of each PDF (e.g. 1-1)")
+    parser.add_argument('--no-cache', action='store_true', help="Convert every PDF, ignoring the conversion cache")
+    parser.add_argument('--no-html', action='store_true', help="Don't write html_out files")
+    parser.add_argument('--no-pdf', action='store_true', help="Stop after JSON (implies --no-markdown)")
+    parser.add_argument('--no-markdown', action='store_true', help="Don't convert PDFs to docling_md")
+    parser.add_argument('--no-template-cache', action='store_true',
+                        help=f"Always re-parse the input instead of using {TEMPLATE_CACHE_DIR}/ in the output directory")
+    args = parser.parse_args()
+
+    run_pipeline(generate_file_count=args.count, input_file=args.input, seed=args.seed, output_dir=args.output_dir,
+                 write_html=not args.no_html, write_pdf=not args.no_pdf, write_markdown_files=not args.no_markdown,
+                 pdf_workers=args.pdf_workers, md_workers=args.md_workers, io_workers=args.io_workers,
+                 queue_size=args.queue_size, profile=args.profile, pages=args.pages,
+                 use_conversion_cache=not args.no_cache, template_cache=None if args.no_template_cache else os.path.join(args.output_dir or '', TEMPLATE_CACHE_DIR))
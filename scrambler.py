@@ -1,121 +1,1353 @@
 import re
-import random
 import os
 import json
 import csv
+import argparse
+import hashlib
+import pickle
+import mmap
+import tempfile
+import mimetypes
+from bisect import bisect_right
+from collections import Counter, deque
 from pathlib import Path
-from weasyprint import HTML, CSS
+from urllib.parse import urlsplit
+from html.parser import HTMLParser
+from urllib.request import url2pathname
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 
 
-def scramble_financial_data(generate_file_count=10, input_file='aapl_p33.html'):
+# Placeholders written into the processed HTML by process_html_content
+PLACEHOLDER_PATTERN = re.compile(r'{{(?:VALUE|CALC)_\d+_[^}]+}}')
+CASH_BALANCE_PLACEHOLDER_PATTERN = re.compile(r'{{CALC_\d+_CASHCASHEQUIVALENTSRESTRICTEDCASHANDRESTRICTEDCASHEQUIVALENTS}}')
+
+
+NUMBER_PATTERN = re.compile(r'[0-9]{1,3}(?:,[0-9]{3})+|[0-9]+')
+MONTH_PATTERN = re.compile(r'january|february|march|april|may|june|july|august|september|october|november|december',
+                           re.IGNORECASE)
+
+
+class FactTokenizer(HTMLParser):
+    """
+    Tokenize a document and collect its ix:nonfraction facts with source offsets.
+
+    Every construct the parser reports (tag, text, entity, comment) starts where
+    the previous one ended, so the span of each text run inside a fact is the gap
+    between consecutive event positions.
+    """
+
+    def __init__(self, html_content):
+        super().__init__(convert_charrefs=False)
+        self.html_content = html_content
+        self.line_starts = [0] + [match.end() for match in re.finditer('\n', html_content)]
+        self.open_facts = []
+        self.facts = []
+        self.split_facts = 0
+
+    def source_position(self):
+        lineno, column = self.getpos()
+        return self.line_starts[lineno - 1] + column
+
+    def event(self, kind):
+        # Every event is recorded in the innermost open fact only
+        if self.open_facts:
+            self.open_facts[-1]['events'].append((kind, self.source_position()))
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'ix:nonfraction':
+            if self.open_facts:
+                # Only the innermost of nested facts holds the displayed text
+                self.open_facts[-1]['nested'] = True
+            self.open_facts.append({'attributes': dict(attrs), 'events': [], 'nested': False,
+                                    'content_start': self.source_position() + len(self.get_starttag_text())})
+        else:
+            self.event('markup')
+
+    def handle_endtag(self, tag):
+        if tag == 'ix:nonfraction' and self.open_facts:
+            self.close_fact(self.open_facts.pop(), self.source_position())
+        else:
+            self.event('markup')
+
+    def handle_startendtag(self, tag, attrs):
+        # A self-closing ix:nonfraction is a nil fact with nothing displayed
+        self.event('markup')
+
+    def handle_data(self, data):
+        self.event('text')
+
+    def handle_entityref(self, name):
+        self.event('text')
+
+    def handle_charref(self, name):
+        self.event('text')
+
+    def handle_comment(self, data):
+        self.event('markup')
+
+    def handle_pi(self, data):
+        self.event('markup')
+
+    def unknown_decl(self, data):
+        self.event('markup')
+
+    def close_fact(self, fact, content_end):
+        if fact['nested']:
+            return
+        # Merge adjacent text and entity events into runs of displayed text
+        runs = []
+        positions = [position for _, position in fact['events']] + [content_end]
+        for (kind, start), end in zip(fact['events'], positions[1:]):
+            if kind != 'text':
+                continue
+            if runs and runs[-1][1] == start:
+                runs[-1][1] = end
+            else:
+                runs.append([start, end])
+        runs = [run for run in runs if self.html_content[run[0]:run[1]].strip()] or [[fact['content_start']] * 2]
+        if len(runs) > 1:
+            # A number split over several elements can't be replaced as one slot
+            self.split_facts += 1
+            return
+        self.facts.append((fact['attributes'], runs[0][0], runs[0][1]))
+
+def extract_facts(html_content):
+    """
+    Extract ix:nonfraction facts in a single tokenizer pass over the document.
+
+    Attributes are read from each fact's own start tag, in any quoting style, so
+    a fact can never pick up the name of a neighbouring tag. A fact's displayed
+    text may sit inside nested markup (e.g. a <span>); its offsets are those of
+    that text run. Facts whose text is split across several elements are skipped
+    with a warning. Cost is linear in the document size.
+
+    Args:
+        html_content (str): Inline XBRL HTML
+
+    Returns:
+        list: One dict per fact with name, contextref, unitref, scale, sign, decimals,
+              id, the displayed text and its exact [start, end) offsets in html_content
+    """
+    tokenizer = FactTokenizer(html_content)
+    tokenizer.feed(html_content)
+    tokenizer.close()
+    if tokenizer.split_facts:
+        print(f"Warning: skipped {tokenizer.split_facts} ix:nonfraction facts whose text is split across elements")
+
+    facts = []
+    for attributes, start, end in sorted(tokenizer.facts, key=lambda fact: fact[1]):
+        scale = attributes.get('scale') or ''
+        facts.append({
+            'name': attributes.get('name'),
+            'contextref': attributes.get('contextref'),
+            'unitref': attributes.get('unitref'),
+            'scale': int(scale) if scale.lstrip('-').isdigit() else 0,
+            'sign': attributes.get('sign') or '',
+            'decimals': attributes.get('decimals'),
+            'id': attributes.get('id'),
+            'text': html_content[start:end],
+            'start': start,
+            'end': end
+        })
+    return facts
+
+
+# SEC-style context ids end in their period: _D<start>-<end> for durations, _I<date> for instants
+CONTEXT_PERIOD_PATTERN = re.compile(r'_(D[0-9]{8}-([0-9]{8})|I([0-9]{8}))$')
+
+
+def context_period(contextref):
+    """Period part of a context id, or the whole id when it doesn't follow the SEC naming"""
+    match = CONTEXT_PERIOD_PATTERN.search(contextref or '')
+    return match.group(1) if match else (contextref or '')
+
+
+def period_end(period):
+    # Sort key: the period's end date, or '' when it can't be read from the id
+    match = CONTEXT_PERIOD_PATTERN.search('_' + period)
+    return (match.group(2) or match.group(3)) if match else ''
+
+
+def group_rows(row_keys):
+    """
+    Index rows by key as ranges of one flat row array.
+
+    Returns:
+        dict: ranges (key -> (start, stop)) and rows (int32, grouped by key in
+              first-seen order, document order within a group)
+    """
+    groups = {}
+    for row, key in enumerate(row_keys):
+        groups.setdefault(key, []).append(row)
+    ranges = {}
+    start = 0
+    for key, group in groups.items():
+        ranges[key] = (start, start + len(group))
+        start += len(group)
+    return {
+        'ranges': ranges,
+        'rows': np.array([row for group in groups.values() for row in group], dtype=np.int32),
+    }
+
+
+def fact_rows(fact_table, tag, period=None):
+    """Rows of a tag's facts, or of its facts for one period, in document order"""
+    index = fact_table['by_tag'] if period is None else fact_table['by_tag_period']
+    start, stop = index['ranges'].get(tag if period is None else (tag, period), (0, 0))
+    return index['rows'][start:stop]
+
+
+def build_fact_table(scrambled_facts):
+    """
+    Store the scrambled facts of a document column by column.
+
+    Tags, contexts and periods are interned into small id arrays, so a fact
+    costs a few array entries rather than a dict. One row is kept per fact, in
+    document order, so repeated facts no longer overwrite each other.
+
+    Args:
+        scrambled_facts (list): (fact, placeholder, is_dependent) per scrambled fact,
+            where fact is a dict from extract_facts with its 'slot' set
+
+    Returns:
+        dict: tags/contexts/periods (id -> string), per-row arrays tag_ids,
+              context_ids, period_ids, values (int64), slots and dependent, the
+              texts and placeholders lists, and the indexes by_tag and
+              by_tag_period (see group_rows and fact_rows)
+    """
+    tags, contexts, periods = {}, {}, {}
+    tag_ids, context_ids, period_ids = [], [], []
+    tag_periods_of_rows = []
+    for fact, _, _ in scrambled_facts:
+        period = context_period(fact['contextref'])
+        tag_ids.append(tags.setdefault(fact['name'], len(tags)))
+        context_ids.append(contexts.setdefault(fact['contextref'], len(contexts)))
+        period_ids.append(periods.setdefault(period, len(periods)))
+        tag_periods_of_rows.append((fact['name'], period))
+
+    texts = [fact['text'] for fact, _, _ in scrambled_facts]
+    return {
+        'tags': list(tags),
+        'contexts': list(contexts),
+        'periods': list(periods),
+        'tag_ids': np.array(tag_ids, dtype=np.int32),
+        'context_ids': np.array(context_ids, dtype=np.int32),
+        'period_ids': np.array(period_ids, dtype=np.int32),
+        'values': parse_original_values(texts),
+        'slots': np.array([fact['slot'] for fact, _, _ in scrambled_facts], dtype=np.int32),
+        'dependent': np.array([is_dependent for _, _, is_dependent in scrambled_facts], dtype=bool),
+        'texts': texts,
+        'placeholders': [placeholder for _, placeholder, _ in scrambled_facts],
+        'by_tag': group_rows([tag for tag, _ in tag_periods_of_rows]),
+        'by_tag_period': group_rows(tag_periods_of_rows),
+    }
+
+
+def tag_periods(fact_table, tag):
+    """
+    Periods of a tag's facts, latest first; year index i of the tag is entry i.
+
+    Returns:
+        list: Period strings, or an empty list for a tag without facts
+    """
+    rows = fact_rows(fact_table, tag)
+    periods = dict.fromkeys(fact_table['periods'][period_id] for period_id in fact_table['period_ids'][rows].tolist())
+    return sorted(periods, key=period_end, reverse=True)
+
+
+def parse_original_values(original_strings):
+    """Parse original value strings such as '99,803' once into an int64 vector"""
+    return np.array([int(value.replace(',', '')) for value in original_strings], dtype=np.int64)
+
+
+def variation_bands(original_values):
+    """Per-value variation range, from the magnitude tiers used when randomizing"""
+    magnitude = np.abs(original_values)
+    return np.where(
+        magnitude < 1000,
+        # Small numbers: ±50% variation, at least ±100
+        np.maximum(100, np.floor(magnitude * 0.5)),
+        np.where(
+            magnitude < 10000,
+            # Medium numbers: ±40% variation
+            np.floor(magnitude * 0.4),
+            # Large numbers: ±30% variation
+            np.floor(magnitude * 0.3)
+        )
+    ).astype(np.int64)
+
+
+def sample_independent_values(original_values, count, rng=None):
+    """
+    Draw randomized independent values for a whole batch of variants at once.
+
+    Args:
+        original_values (np.ndarray): int64 vector of original values
+        count (int): Number of variants to sample
+        rng (np.random.Generator): Random generator (default: a fresh unseeded one)
+
+    Returns:
+        np.ndarray: int64 matrix of shape (count, len(original_values))
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    bands = variation_bands(original_values)
+    variations = rng.integers(-bands, bands, size=(count, len(original_values)), endpoint=True)
+    sampled = original_values + variations
+    
+    # Ensure we don't flip the sign for large positive numbers
+    flipped = (original_values > 10000) & (sampled < 0)
+    return np.where(flipped, np.abs(sampled), sampled)
+
+
+def variant_rng(seed, index):
+    """Independent random generator for variant `index` of a seeded run"""
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(index,)))
+
+
+def format_sampled_value(value, with_commas):
+    """Format a sampled value with commas if the original had them"""
+    return f"{value:,}" if with_commas else str(value)
+
+
+NET_INCOME_TAG = 'us-gaap:NetIncomeLoss'
+CASH_CHANGE_TAG = 'us-gaap:CashCashEquivalentsRestrictedCashAndRestrictedCashEquivalentsPeriodIncreaseDecreaseIncludingExchangeRateEffect'
+ENDING_CASH_TAG = 'us-gaap:CashCashEquivalentsRestrictedCashAndRestrictedCashEquivalents'
+
+# Line items summed into each calculated total, with the sign they enter with
+DEPENDENT_TOTALS = {
+    'us-gaap:NetCashProvidedByUsedInOperatingActivities': [
+        (NET_INCOME_TAG, 1),
+        ('us-gaap:DepreciationDepletionAndAmortization', 1),
+        ('us-gaap:ShareBasedCompensation', 1),
+        ('us-gaap:DeferredIncomeTaxExpenseBenefit', 1),
+        ('us-gaap:IncreaseDecreaseInAccountsReceivable', 1),
+        ('us-gaap:IncreaseDecreaseInAccountsPayable', 1),
+        ('us-gaap:IncreaseDecreaseInInventories', 1),
+        ('us-gaap:IncreaseDecreaseInOtherReceivables', 1),
+        ('us-gaap:IncreaseDecreaseInOtherOperatingAssets', 1),
+        ('us-gaap:IncreaseDecreaseInContractWithCustomerLiability', 1),
+        ('us-gaap:IncreaseDecreaseInOtherOperatingLiabilities', 1),
+        ('us-gaap:OtherNoncashIncomeExpense', 1),
+    ],
+    # Payments are typically negative
+    'us-gaap:NetCashProvidedByUsedInInvestingActivities': [
+        ('us-gaap:ProceedsFromSaleOfAvailableForSaleSecuritiesDebt', 1),
+        ('us-gaap:ProceedsFromMaturitiesPrepaymentsAndCallsOfAvailableForSaleSecurities', 1),
+        ('us-gaap:PaymentsToAcquireAvailableForSaleSecuritiesDebt', -1),
+        ('us-gaap:PaymentsToAcquirePropertyPlantAndEquipment', -1),
+        ('us-gaap:PaymentsToAcquireBusinessesNetOfCashAcquired', -1),
+        ('us-gaap:PaymentsForProceedsFromOtherInvestingActivities', -1),
+    ],
+    # Most are negative cash flows
+    'us-gaap:NetCashProvidedByUsedInFinancingActivities': [
+        ('us-gaap:ProceedsFromIssuanceOfLongTermDebt', 1),
+        ('us-gaap:RepaymentsOfLongTermDebt', -1),
+        ('us-gaap:PaymentsForRepurchaseOfCommonStock', -1),
+        ('us-gaap:PaymentsOfDividends', -1),
+        ('us-gaap:PaymentsRelatedToTaxWithholdingForShareBasedCompensation', -1),
+        ('us-gaap:ProceedsFromRepaymentsOfCommercialPaper', 1),
+        ('us-gaap:ProceedsFromPaymentsForOtherFinancingActivities', 1),
+    ],
+}
+
+
+def build_dependent_model(columns_by_tag, value_count, beginning_cash_values=()):
+    """
+    Express every calculated total as a linear function of the independent values.
+
+    Each year's operating, investing and financing totals and cash change are rows
+    of a coefficient matrix over the independent-value vector. Ending cash balances
+    add the original beginning cash as an intercept and are floored at 10,000.
+
+    Args:
+        columns_by_tag (dict): XBRL tag -> independent-value columns, one per year in order
+        value_count (int): Number of independent values (matrix columns)
+        beginning_cash_values (list): Original beginning cash balances, one per year
+
+    Returns:
+        dict: keys (one '{tag}_{year}' per row), coefficients, intercepts and minimums
+    """
+    keys = []
+    rows = []
+
+    # Calculate for each year (assuming we have 3 years of data)
+    num_years = max(len(columns_by_tag.get(NET_INCOME_TAG, [])), 3)
+    for year_idx in range(num_years):
+        year_rows = []
+        for total_tag, components in DEPENDENT_TOTALS.items():
+            row = np.zeros(value_count, dtype=np.int64)
+            for tag, sign in components:
+                columns = columns_by_tag.get(tag, [])
+                if year_idx < len(columns):
+                    row[columns[year_idx]] += sign
+            keys.append(f"{total_tag}_{year_idx}")
+            year_rows.append(row)
+        rows.extend(year_rows)
+
+        # Overall cash change is the sum of the three activity totals
+        keys.append(f"{CASH_CHANGE_TAG}_{year_idx}")
+        rows.append(sum(year_rows))
+
+    intercepts = [0] * len(rows)
+    minimums = [np.iinfo(np.int64).min] * len(rows)
+
+    # Ending cash = beginning cash + that year's cash change, kept positive
+    for year_idx, beginning_cash in enumerate(beginning_cash_values[:3]):
+        keys.append(f"{ENDING_CASH_TAG}_ending_{year_idx}")
+        rows.append(rows[keys.index(f"{CASH_CHANGE_TAG}_{year_idx}")].copy())
+        intercepts.append(beginning_cash)
+        minimums.append(10000)
+
+    return {
+        'keys': keys,
+        'coefficients': np.array(rows, dtype=np.int64).reshape(len(rows), value_count),
+        'intercepts': np.array(intercepts, dtype=np.int64),
+        'minimums': np.array(minimums, dtype=np.int64)
+    }
+
+
+def evaluate_dependent_model(model, sampled_values):
+    """
+    Calculate every dependent value for a batch of variants at once.
+
+    Args:
+        model (dict): Result of build_dependent_model
+        sampled_values (np.ndarray): (variant_count, value_count) independent values
+
+    Returns:
+        np.ndarray: (variant_count, len(model['keys'])) calculated values
+    """
+    totals = sampled_values @ model['coefficients'].T + model['intercepts']
+    return np.maximum(totals, model['minimums'])
+
+
+# Rows of the ground-truth JSON. 4-tuples are literal rows; 3-tuples are
+# (label, XBRL tag, shown in parentheses) and take one value per year.
+CASH_FLOW_ROWS = [
+    # Headers
+    ("", "", "Years ended", ""),
+    ("", "September 24, 2022", "September 25, 2021", "September 26, 2020"),
+
+    # Cash beginning balances
+    ("Cash, cash equivalents and restricted cash, beginning balances", "us-gaap:CashCashEquivalentsRestrictedCashAndRestrictedCashEquivalents", True),
+
+    # Operating activities section
+    ("Operating activities:", "", "", ""),
+    ("Net income", "us-gaap:NetIncomeLoss", False),
+    ("Adjustments to reconcile net income to cash generated by operating activities:", "", "", ""),
+    ("Depreciation and amortization", "us-gaap:DepreciationDepletionAndAmortization", False),
+    ("Share-based compensation expense", "us-gaap:ShareBasedCompensation", False),
+    ("Deferred income tax expense/(benefit)", "us-gaap:DeferredIncomeTaxExpenseBenefit", False),
+    ("Other", "us-gaap:OtherNoncashIncomeExpense", False),
+    ("Changes in operating assets and liabilities:", "", "", ""),
+    ("Accounts receivable, net", "us-gaap:IncreaseDecreaseInAccountsReceivable", True),
+    ("Inventories", "us-gaap:IncreaseDecreaseInInventories", True),
+    ("Vendor non-trade receivables", "us-gaap:IncreaseDecreaseInOtherReceivables", True),
+    ("Other current and non-current assets", "us-gaap:IncreaseDecreaseInOtherOperatingAssets", True),
+    ("Accounts payable", "us-gaap:IncreaseDecreaseInAccountsPayable", False),
+    ("Deferred revenue", "us-gaap:IncreaseDecreaseInContractWithCustomerLiability", False),
+    ("Other current and non-current liabilities", "us-gaap:IncreaseDecreaseInOtherOperatingLiabilities", False),
+    ("Cash generated by operating activities", "us-gaap:NetCashProvidedByUsedInOperatingActivities", False),
+
+    # Investing activities section
+    ("Investing activities:", "", "", ""),
+    ("Purchases of marketable securities", "us-gaap:PaymentsToAcquireMarketableSecurities", True),
+    ("Proceeds from maturities of marketable securities", "us-gaap:ProceedsFromMaturitiesPrepaymentsAndCallsOfAvailableForSaleSecurities", False),
+    ("Proceeds from sales of marketable securities", "us-gaap:ProceedsFromSaleOfAvailableForSaleSecuritiesDebt", False),
+    ("Payments for acquisition of property, plant and equipment", "us-gaap:PaymentsToAcquirePropertyPlantAndEquipment", True),
+    ("Payments made in connection with business acquisitions, net", "us-gaap:PaymentsToAcquireBusinessesNetOfCashAcquired", True),
+    ("Other", "us-gaap:PaymentsForProceedsFromOtherInvestingActivities", True),
+    ("Cash used in investing activities", "us-gaap:NetCashProvidedByUsedInInvestingActivities", True),
+
+    # Financing activities section
+    ("Financing activities:", "", "", ""),
+    ("Payments for taxes related to net share settlement of equity awards", "us-gaap:PaymentsRelatedToTaxWithholdingForShareBasedCompensation", True),
+    ("Payments for dividends and dividend equivalents", "us-gaap:PaymentsOfDividends", True),
+    ("Repurchases of common stock", "us-gaap:PaymentsForRepurchaseOfCommonStock", True),
+    ("Proceeds from issuance of term debt, net", "us-gaap:ProceedsFromIssuanceOfLongTermDebt", False),
+    ("Repayments of term debt", "us-gaap:RepaymentsOfLongTermDebt", True),
+    ("Proceeds from/(Repayments of) commercial paper, net", "us-gaap:ProceedsFromRepaymentsOfCommercialPaper", False),
+    ("Other", "us-gaap:ProceedsFromPaymentsForOtherFinancingActivities", False),
+    ("Cash used in financing activities", "us-gaap:NetCashProvidedByUsedInFinancingActivities", True),
+
+    # Cash change and ending balance
+    ("Decrease in cash, cash equivalents and restricted cash", "us-gaap:CashCashEquivalentsRestrictedCashAndRestrictedCashEquivalentsPeriodIncreaseDecreaseIncludingExchangeRateEffect", True),
+    ("Cash, cash equivalents and restricted cash, ending balances", "us-gaap:CashCashEquivalentsRestrictedCashAndRestrictedCashEquivalentsEnding", True),  # ending balance
+
+    # Supplemental disclosures
+    ("Supplemental cash flow disclosure:", "", "", ""),
+    ("Cash paid for income taxes, net", "us-gaap:IncomeTaxesPaid", False),
+    ("Cash paid for interest", "us-gaap:InterestPaidNet", False)
+]
+
+# Tags tried in order when a row's own tag has no values
+ENDING_CASH_ALTERNATE_TAGS = [
+    "us-gaap:CashCashEquivalentsRestrictedCashAndRestrictedCashEquivalents",
+    "us-gaap:CashAndCashEquivalentsAtCarryingValue"
+]
+INCOME_TAXES_ALTERNATE_TAGS = ["us-gaap:IncomeTaxesPaidNet", "us-gaap:CashPaidForIncomeTaxes"]
+INTEREST_ALTERNATE_TAGS = ["us-gaap:InterestPaid", "us-gaap:CashPaidForInterest"]
+
+# Fact text that counts as a value in the JSON rows
+DIGITS_PATTERN = re.compile(r'[0-9,]+')
+
+
+def format_value(value_str, is_negative_item=False, add_dollar=False):
+    """Format value with proper dollar signs and parentheses"""
+    if not value_str or value_str == "":
+        return ""
+        
+    # Remove commas for processing
+    clean_value = value_str.replace(',', '')
+    
+    # Check if it's a number
+    try:
+        num_value = int(clean_value)
+        # Add commas back
+        formatted = f"{abs(num_value):,}"
+        
+        # Add parentheses for negative items or negative values
+        if is_negative_item or num_value < 0:
+            formatted = f"({formatted})"
+        
+        # Add dollar sign if required
+        if add_dollar:
+            formatted = f"$ {formatted}"
+            
+        return formatted
+    except:
+        return value_str
+
+
+def plan_financial_data(values_by_tag):
+    """
+    Resolve once which fact feeds each year of each JSON row.
+
+    Args:
+        values_by_tag (dict): XBRL tag -> value sources in document order, where a
+            source is a template slot index or the fact's unchanged text
+
+    Returns:
+        list: Literal rows (lists) and (label, sources, is_negative, add_dollar) tuples
+    """
+    def values_for(tag_name, count=3):
+        """Value sources for a specific XBRL tag (up to 3 years)"""
+        return values_by_tag.get(tag_name, [])[:count]
+
+    def first_available(alt_tags):
+        for alt_tag in alt_tags:
+            values = values_for(alt_tag)
+            if values:
+                return values
+        return []
+
+    json_plan = []
+    for row in CASH_FLOW_ROWS:
+        if len(row) == 4:
+            # Header row
+            json_plan.append(list(row))
+            continue
+
+        label, tag, is_negative = row
+        if tag == "" or not tag:
+            # Section header - empty values
+            json_plan.append([label, "", "", ""])
+            continue
+
+        values = values_for(tag)
+
+        # Special handling for ending cash balances and supplemental disclosures
+        if "ending balances" in label.lower():
+            # For ending cash, try multiple tag patterns
+            if not values:
+                values = first_available(ENDING_CASH_ALTERNATE_TAGS)
+            # Take the last 3 values as they represent ending balances
+            if values and len(values) >= 3:
+                values = values[-3:]
+        elif "cash paid for income taxes" in label.lower():
+            if not values:
+                values = first_available(INCOME_TAXES_ALTERNATE_TAGS)
+        elif "cash paid for interest" in label.lower():
+            if not values:
+                values = first_available(INTEREST_ALTERNATE_TAGS)
+
+        # Determine if dollar signs are needed (cash balances and supplemental items)
+        add_dollar = ("cash" in label.lower() and "balances" in label.lower()) or ("cash paid" in label.lower())
+
+        if len(values) >= 3:
+            json_plan.append((label, values[:3], is_negative, add_dollar))
+        elif "cash paid for income taxes" in label.lower():
+            # Generate reasonable tax values
+            fallback_values = ["19,000", "24,000", "9,000"]
+            json_plan.append([label] + [format_value(val, False, True) for val in fallback_values])
+        elif "cash paid for interest" in label.lower():
+            # Generate reasonable interest values
+            fallback_values = ["2,800", "2,600", "2,900"]
+            json_plan.append([label] + [format_value(val, False, True) for val in fallback_values])
+        else:
+            json_plan.append([label, "", "", ""])
+
+    return json_plan
+
+
+def build_financial_data(json_plan, slot_values):
+    """
+    Build one variant's ground-truth JSON rows from its rendered slot values.
+
+    Args:
+        json_plan (list): Result of plan_financial_data
+        slot_values (list): The variant's rendered string for every template slot
+
+    Returns:
+        list: JSON rows of [label, year 1, year 2, year 3]
+    """
+    json_data = []
+    for entry in json_plan:
+        if isinstance(entry, list):
+            json_data.append(list(entry))
+        else:
+            label, sources, is_negative, add_dollar = entry
+            values = [slot_values[source] if isinstance(source, int) else source for source in sources]
+            json_data.append([label] + [format_value(value, is_negative, add_dollar) for value in values])
+    return json_data
+
+
+def compile_template(processed_content):
+    """
+    Split processed HTML into literal segments and placeholder slots.
+
+    The result is reused for every variant: segments[i] is the literal text
+    before slots[i], and segments[-1] is the text after the last slot.
+
+    Args:
+        processed_content (str): HTML with {{VALUE_...}} / {{CALC_...}} placeholders
+
+    Returns:
+        tuple: (segments, slots) where slots is the list of placeholder strings
+    """
+    segments = []
+    slots = []
+    last_end = 0
+    for match in PLACEHOLDER_PATTERN.finditer(processed_content):
+        segments.append(processed_content[last_end:match.start()])
+        slots.append(match.group(0))
+        last_end = match.end()
+    segments.append(processed_content[last_end:])
+    return segments, slots
+
+
+def render_template(segments, slot_values):
+    """Interleave template segments with one rendered string per slot"""
+    parts = [None] * (len(segments) + len(slot_values))
+    parts[0::2] = segments
+    parts[1::2] = slot_values
+    return ''.join(parts)
+
+
+# Markup that cannot change a rendered page
+IX_HEADER_PATTERN = re.compile(r'<div style="display:none">\s*<ix:header\b.*?</ix:header>\s*</div>'
+                               r'|<ix:header\b.*?</ix:header>', re.IGNORECASE | re.DOTALL)
+COMMENT_PATTERN = re.compile(r'<!--.*?-->', re.DOTALL)
+SCRIPT_PATTERN = re.compile(r'<script\b.*?</script>', re.IGNORECASE | re.DOTALL)
+LINK_PATTERN = re.compile(r'<link(?=[\s/>])[^>]*>', re.IGNORECASE)
+HREF_PATTERN = re.compile(r'\bhref\s*=\s*["\']([^"\']*)', re.IGNORECASE)
+URL_SCHEME_PATTERN = re.compile(r'([a-z][a-z0-9+.-]*):', re.IGNORECASE)
+STYLE_PATTERN = re.compile(r'<style\b[^>]*>(.*?)</style>', re.IGNORECASE | re.DOTALL)
+CSS_COMMENT_PATTERN = re.compile(r'/\*.*?\*/', re.DOTALL)
+CSS_RULE_PATTERN = re.compile(r'\s*([^{}@]+)\{[^{}]*\}\s*')
+HEADER_SELECTOR_PATTERN = re.compile(r'\s*ix\\:header\b', re.IGNORECASE)
+
+
+def is_dead_link(tag):
+    """A <link> whose target has a non-local scheme (e.g. chrome-extension://); offline renders skip it"""
+    href = HREF_PATTERN.search(tag)
+    scheme = URL_SCHEME_PATTERN.match(href.group(1)) if href else None
+    return scheme is not None and scheme.group(1).lower() not in ('file', 'data')
+
+
+def is_dead_style(css, header_removed):
+    """A <style> block with no rules, or (once ix:header is gone) only rules for ix:header"""
+    css = CSS_COMMENT_PATTERN.sub('', css)
+    if not css.strip():
+        return True
+    if not header_removed:
+        return False
+    rules = list(CSS_RULE_PATTERN.finditer(css))
+    if not rules or ''.join(rule.group(0) for rule in rules) != css:
+        return False
+    return all(HEADER_SELECTOR_PATTERN.match(selector)
+               for rule in rules for selector in rule.group(1).split(','))
+
+
+def minimize_template(segments):
+    """
+    Cut markup that cannot affect a rendered page out of a compiled template.
+
+    Removes the hidden ix:header block (with its display:none wrapper), comments, scripts, <link> tags pointing at
+    non-local schemes and <style> blocks left with nothing to style. Slots inside a
+    removed span (hidden header facts) are dropped with it.
+
+    Args:
+        segments (list): Template segments from compile_template
+
+    Returns:
+        dict: segments of the minimized template and slots, the index of the
+              original slot filling each of its slots
+    """
+    # One marker character per slot, so removal works on the whole document at once
+    marker = '\0'
+    joined = marker.join(segments)
+    if joined.count(marker) != len(segments) - 1:
+        raise ValueError("Template already contains the slot marker character")
+
+    header_removed = False
+    removed = []
+    for match in IX_HEADER_PATTERN.finditer(joined):
+        removed.append(match.span())
+        header_removed = True
+    for pattern in (COMMENT_PATTERN, SCRIPT_PATTERN):
+        removed.extend(match.span() for match in pattern.finditer(joined))
+    removed.extend(match.span() for match in LINK_PATTERN.finditer(joined) if is_dead_link(match.group(0)))
+    removed.extend(match.span() for match in STYLE_PATTERN.finditer(joined)
+                   if is_dead_style(match.group(1), header_removed))
+
+    # Merge overlapping spans (e.g. a comment inside the header)
+    spans = []
+    for start, end in sorted(removed):
+        if spans and start <= spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], end)
+        else:
+            spans.append([start, end])
+
+    kept = []
+    last_end = 0
+    for start, end in spans:
+        kept.append(joined[last_end:start])
+        last_end = end
+    kept.append(joined[last_end:])
+    minimized = ''.join(kept)
+
+    span_starts = [start for start, _ in spans]
+    slots = []
+    for slot, match in enumerate(re.finditer(marker, joined)):
+        span_idx = bisect_right(span_starts, match.start()) - 1
+        if span_idx < 0 or match.start() >= spans[span_idx][1]:
+            slots.append(slot)
+    return {'segments': minimized.split(marker), 'slots': slots}
+
+
+def render_pdf_html(compiled, slot_values, minimize=True):
+    """
+    HTML a variant's PDF is rendered from.
+
+    Args:
+        compiled (dict): Result of compile_document (or a variant worker's view of it)
+        slot_values (list): One rendered string per template slot
+        minimize (bool): Use the minimized PDF template (default: True)
+
+    Returns:
+        str: The HTML document
+    """
+    if minimize:
+        segments = compiled['pdf_template']['segments']
+        slot_values = [slot_values[slot] for slot in compiled['pdf_template']['slots']]
+    else:
+        segments = compiled['segments']
+    if segments and isinstance(segments[0], str):
+        return render_template(segments, slot_values)
+    # Memory-mapped segments of a variant worker
+    return render_template_bytes(segments, slot_values).decode('utf-8')
+
+
+# Stylesheet applied to every PDF render
+PDF_STYLESHEET = '''
+    @page {
+        size: letter;
+        margin: 0.75in 1in;
+        @top-center {
+            content: "Apple Inc. - Financial Statement";
+            font-family: Helvetica, sans-serif;
+            font-size: 10pt;
+            font-weight: bold;
+        }
+        @bottom-center {
+            content: "Page " counter(page) " of " counter(pages);
+            font-family: Helvetica, sans-serif;
+            font-size: 9pt;
+        }
+    }
+
+    /* Base styling */
+    body {
+        font-family: Helvetica, Arial, sans-serif;
+        font-size: 8.5pt;
+        line-height: 1.2;
+        color: #000000;
+        margin: 0;
+        padding: 0;
+    }
+
+    /* Hide XBRL metadata */
+    div[style*="display:none"], 
+    ix\\:header, 
+    ix\\:header * {
+        display: none !important;
+    }
+
+    /* Main content styling */
+    div {
+        page-break-inside: avoid;
+    }
+
+    /* Table styling for financial statements */
+    table {
+        width: 100%;
+        border-collapse: collapse;
+        margin-bottom: 12pt;
+        page-break-inside: avoid;
+        font-size: 8.5pt;
+    }
+
+    /* Table cells */
+    td {
+        padding: 2px 4px;
+        vertical-align: top;
+        border: none;
+    }
+
+    /* Header rows with borders */
+    td[style*="border-top"] {
+        border-top: 1pt solid #000000;
+    }
+
+    /* Alternating row backgrounds */
+    tr:has(td[style*="background-color:#efefef"]) {
+        background-color: #efefef;
+    }
+
+    tr:has(td[style*="background-color:#ffffff"]) {
+        background-color: #ffffff;
+    }
+
+    /* Text alignment */
+    .text-center, 
+    td[style*="text-align:center"] {
+        text-align: center;
+    }
+
+    .text-right, 
+    td[style*="text-align:right"] {
+        text-align: right;
+    }
+
+    .text-left, 
+    td[style*="text-align:left"] {
+        text-align: left;
+    }
+
+    /* Typography */
+    span[style*="font-weight:700"] {
+        font-weight: bold;
+    }
+
+    span[style*="font-size:9pt"] {
+        font-size: 9pt;
+    }
+
+    span[style*="font-size:8pt"] {
+        font-size: 8pt;
+    }
+
+    span[style*="font-size:8.5pt"] {
+        font-size: 8.5pt;
+    }
+
+    /* Title styling */
+    div:has(span[style*="font-weight:700"][style*="font-size:9pt"]) {
+        text-align: center;
+        margin: 12pt 0;
+        font-weight: bold;
+    }
+
+    /* Ensure numbers align properly */
+    span:contains("$"), 
+    span:contains("(") {
+        font-family: "Courier New", monospace;
+    }
+
+    /* Page break controls */
+    .page-break-before {
+        page-break-before: always;
+    }
+
+    .page-break-after {
+        page-break-after: always;
+    }
+
+    .no-page-break {
+        page-break-inside: avoid;
+    }
+
+    /* Financial statement specific styling */
+    div[style*="min-height:42.75pt"] {
+        min-height: 42.75pt;
+        page-break-after: avoid;
+    }
+
+    /* Indentation levels for financial line items */
+    div[style*="padding-left:9pt"] {
+        padding-left: 9pt;
+    }
+
+    div[style*="padding-left:15.75pt"] {
+        padding-left: 15.75pt;
+    }
+
+    div[style*="padding-left:27pt"] {
+        padding-left: 27pt;
+    }
+
+    div[style*="padding-left:30.25pt"] {
+        padding-left: 30.25pt;
+    }
+
+    /* Print-specific optimizations */
+    @media print {
+        body {
+            -webkit-print-color-adjust: exact;
+            print-color-adjust: exact;
+        }
+        
+        table {
+            font-size: 8pt;
+        }
+        
+        /* Ensure financial tables don't break across pages */
+        table[style*="border-collapse:collapse"] {
+            page-break-inside: avoid;
+        }
+    }
+    '''
+
+# Selector features that are valid but costly to match on large statements
+COSTLY_SELECTOR_PATTERNS = [
+    (re.compile(r'\[[^\]]*[*^$~|]='), 'attribute substring match'),
+    (re.compile(r':has\(', re.IGNORECASE), 'relational :has()'),
+]
+
+
+def split_selector_list(prelude):
+    """Split a rule prelude into its comma-separated selectors (commas inside :has(...) stay put)"""
+    import tinycss2
+    selectors = [[]]
+    for token in prelude:
+        if token.type == 'literal' and token.value == ',':
+            selectors.append([])
+        else:
+            selectors[-1].append(token)
+    return [tinycss2.serialize(tokens).strip() for tokens in selectors]
+
+
+def validate_stylesheet(css_text):
+    """
+    Check every selector of a stylesheet the way WeasyPrint compiles it.
+
+    A rule with any selector WeasyPrint cannot compile (e.g. span:contains("$"))
+    is dropped whole, as WeasyPrint itself would after logging a warning on
+    every render, so the validated stylesheet renders identically and silently.
+    Valid selectors that are costly to match are listed but kept.
+
+    Args:
+        css_text (str): Stylesheet source
+
+    Returns:
+        dict: css (the validated stylesheet), selectors (one (selector, compiled
+              selector or None) pair per selector kept) and issues (one
+              {'selector', 'issue'} dict per unsupported or costly selector)
+    """
+    import tinycss2
+    import cssselect2
+    issues = []
+    compiled_selectors = []
+
+    def validate_rules(rules):
+        kept = []
+        for rule in rules:
+            if rule.type == 'qualified-rule':
+                selectors = split_selector_list(rule.prelude)
+                try:
+                    compiled = cssselect2.compile_selector_list(rule.prelude)
+                except cssselect2.SelectorError as e:
+                    reason = ': '.join(str(arg) for arg in e.args)
+                    issues.extend({'selector': selector, 'issue': f"unsupported ({reason}), rule dropped"}
+                                  for selector in selectors)
+                    continue
+                for selector, compiled_selector in zip(selectors, compiled):
+                    compiled_selectors.append((selector, compiled_selector))
+                    costs = [issue for pattern, issue in COSTLY_SELECTOR_PATTERNS if pattern.search(selector)]
+                    if costs:
+                        issues.append({'selector': selector, 'issue': ', '.join(costs)})
+                kept.append(tinycss2.serialize([rule]))
+            elif rule.type == 'at-rule' and rule.lower_at_keyword == 'media' and rule.content is not None:
+                inner = validate_rules(tinycss2.parse_rule_list(rule.content, skip_comments=True,
+                                                                skip_whitespace=True))
+                kept.append(f"@media{tinycss2.serialize(rule.prelude)}{{{inner}}}")
+            elif rule.type != 'error':
+                kept.append(tinycss2.serialize([rule]))
+        return '\n'.join(kept)
+
+    css = validate_rules(tinycss2.parse_stylesheet(css_text, skip_comments=True, skip_whitespace=True))
+    return {'css': css, 'selectors': compiled_selectors, 'issues': issues}
+
+
+# PDF_STYLESHEET after validate_stylesheet, computed once per process
+_validated_stylesheet = None
+
+
+def validated_pdf_stylesheet():
+    """PDF_STYLESHEET validated once per process; see validate_stylesheet"""
+    global _validated_stylesheet
+    if _validated_stylesheet is None:
+        _validated_stylesheet = validate_stylesheet(PDF_STYLESHEET)
+    return _validated_stylesheet
+
+
+def stylesheet_diagnostics(html_content, repeat=5):
+    """
+    Measure what each PDF stylesheet selector costs when matching one document.
+
+    The document is parsed as WeasyPrint parses it and every element is run
+    through a cssselect2 matcher holding a single selector, the way the cascade
+    matches each render, so the time includes the matcher's tag/class prefiltering.
+
+    Args:
+        html_content (str): A document as rendered to PDF (e.g. render_pdf_html output)
+        repeat (int): Matching passes averaged per selector (default: 5)
+
+    Returns:
+        list: One dict per selector with selector, issue (or None), matches and
+              ms (matching time per render), costliest first, then the
+              unsupported selectors that were dropped
+    """
+    import time
+    import tinyhtml5
+    import cssselect2
+    validated = validated_pdf_stylesheet()
+    root = cssselect2.ElementWrapper.from_html_root(tinyhtml5.parse(html_content))
+    elements = list(root.iter_subtree())
+    issues = {issue['selector']: issue['issue'] for issue in validated['issues']}
+
+    report = []
+    for selector, compiled_selector in validated['selectors']:
+        matcher = cssselect2.Matcher()
+        matcher.add_selector(compiled_selector, None)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            matches = sum(1 for element in elements if matcher.match(element))
+        report.append({
+            'selector': selector,
+            'issue': issues.get(selector),
+            'matches': matches,
+            'ms': 1000 * (time.perf_counter() - start) / repeat,
+        })
+    report.sort(key=lambda entry: entry['ms'], reverse=True)
+    report.extend({'selector': issue['selector'], 'issue': issue['issue'], 'matches': None, 'ms': None}
+                  for issue in validated['issues'] if issue['issue'].startswith('unsupported'))
+    return report
+
+
+# Parsed stylesheet and offline URL fetcher of the current rendering process, set once by init_pdf_worker
+_worker_stylesheet = None
+_worker_fetcher = None
+
+
+def build_offline_fetcher():
+    """
+    Create a WeasyPrint URL fetcher that never touches the network.
+
+    Local files under an allowed directory (see allow_dir) and data: URLs are read
+    once and then served from an in-process cache. Everything else (chrome-extension://,
+    http(s)://, files outside the allowed directories) is skipped without any I/O:
+    stylesheets resolve to an empty sheet so WeasyPrint renders on silently, other
+    resources fail fast. The fetcher's counts record what was loaded, served from
+    the cache and skipped (by scheme).
+
+    Returns:
+        URLFetcher: The fetcher, to pass as url_fetcher to HTML and CSS
+    """
+    from weasyprint.urls import URLFetcher, URLFetcherResponse
+
+    class OfflineURLFetcher(URLFetcher):
+        def __init__(self):
+            super().__init__(allowed_protocols=('file', 'data'))
+            self.allowed_dirs = set()
+            self.cache = {}
+            self.counts = Counter()
+
+        def allow_dir(self, base_url):
+            """Allow local assets under base_url (a directory path or file: URL)"""
+            if base_url:
+                path = url2pathname(urlsplit(base_url).path) if base_url.startswith('file:') else base_url
+                self.allowed_dirs.add(os.path.join(os.path.realpath(path), ''))
+
+        def fetch(self, url, headers=None):
+            cached = self.cache.get(url)
+            if cached is not None:
+                self.counts['cached'] += 1
+                return URLFetcherResponse(url, *cached)
+
+            scheme = urlsplit(url).scheme.lower()
+            if scheme == 'data':
+                response = super().fetch(url, headers)
+                cached = (response.read(), dict(response.headers))
+                response.close()
+            elif scheme == 'file':
+                path = os.path.realpath(url2pathname(urlsplit(url).path))
+                if not any(path.startswith(d) for d in self.allowed_dirs):
+                    return self.skip(url, 'outside assets')
+                with open(path, 'rb') as f:
+                    body = f.read()
+                cached = (body, {'Content-Type': mimetypes.guess_type(path)[0] or 'application/octet-stream'})
+            else:
+                return self.skip(url, scheme or 'relative')
+
+            self.counts['loaded'] += 1
+            self.cache[url] = cached
+            return URLFetcherResponse(url, *cached)
+
+        def skip(self, url, reason):
+            self.counts[f'skipped {reason}'] += 1
+            if urlsplit(url).path.lower().endswith('.css'):
+                return URLFetcherResponse(url, b'', {'Content-Type': 'text/css'})
+            raise ValueError(f"Skipped offline: {url}")
+
+    return OfflineURLFetcher()
+
+
+def take_fetch_counts():
+    """Return and reset this process's asset fetch counts"""
+    if _worker_fetcher is None:
+        return Counter()
+    counts = _worker_fetcher.counts
+    _worker_fetcher.counts = Counter()
+    return counts
+
+
+def format_fetch_counts(counts):
+    """One-line summary of asset fetch counts, e.g. '1 loaded, 99 cached, 38 skipped (38 chrome-extension)'"""
+    skipped = {key[len('skipped '):]: n for key, n in counts.items() if key.startswith('skipped ')}
+    summary = f"{counts['loaded']} loaded, {counts['cached']} cached, {sum(skipped.values())} skipped"
+    if skipped:
+        summary += ' (' + ', '.join(f"{n} {reason}" for reason, n in sorted(skipped.items())) + ')'
+    return summary
+
+
+def init_pdf_worker():
+    """Parse the validated PDF stylesheet and create the offline fetcher once so every render in this process reuses them"""
+    global _worker_stylesheet, _worker_fetcher
+    if _worker_stylesheet is not None:
+        return
+    # WeasyPrint is imported on first use so HTML/JSON-only runs never load it
+    from weasyprint import CSS
+    _worker_fetcher = build_offline_fetcher()
+    _worker_stylesheet = CSS(string=validated_pdf_stylesheet()['css'], url_fetcher=_worker_fetcher)
+
+
+def load_html(html_content, base_url):
+    """WeasyPrint HTML for a document, resolving its assets through the process's offline fetcher"""
+    from weasyprint import HTML
+    if _worker_stylesheet is None:
+        init_pdf_worker()
+    _worker_fetcher.allow_dir(base_url)
+    return HTML(string=html_content, base_url=base_url, url_fetcher=_worker_fetcher)
+
+
+def render_pdf_job(job):
+    """
+    Render one (html_content, pdf_file, base_url) job with the process's parsed stylesheet.
+
+    Returns:
+        tuple: (pdf_file, error message or None, asset fetch counts of this render)
+    """
+    html_content, pdf_file, base_url = job
+    try:
+        load_html(html_content, base_url).write_pdf(pdf_file, stylesheets=[_worker_stylesheet])
+        return pdf_file, None, take_fetch_counts()
+    except Exception as e:
+        return pdf_file, str(e), take_fetch_counts()
+
+
+def bounded_map(pool, fn, items, window):
+    """
+    Like pool.map, but read items lazily with at most `window` jobs in flight.
+
+    pool.map submits its whole input up front; with a generator of in-memory
+    documents that would hold every document at once.
+
+    Yields:
+        fn(item) for every item, in input order
+    """
+    in_flight = deque()
+    for item in items:
+        if len(in_flight) >= window:
+            yield in_flight.popleft().result()
+        in_flight.append(pool.submit(fn, item))
+    while in_flight:
+        yield in_flight.popleft().result()
+
+
+def render_pdfs(jobs, workers=1):
+    """
+    Render HTML documents to PDF, optionally across a pool of warm worker processes.
+
+    Each worker imports WeasyPrint and parses the stylesheet once, then renders its
+    share of the queue. Failures are reported per file and do not stop the run.
+
+    Args:
+        jobs (iterable): (html_content, pdf_file, base_url) jobs, consumed lazily; the
+            pool holds about two jobs per worker at a time
+        workers (int): Number of worker processes; 1 renders in this process (default: 1)
+
+    Returns:
+        list: PDF files that were generated successfully
+    """
+    generated = []
+    fetch_counts = Counter()
+    if workers <= 1:
+        init_pdf_worker()
+        results = map(render_pdf_job, jobs)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=init_pdf_worker)
+        results = bounded_map(pool, render_pdf_job, jobs, window=2 * workers)
+
+    try:
+        for pdf_file, error, counts in results:
+            fetch_counts.update(counts)
+            if error is None:
+                generated.append(pdf_file)
+                print(f"Generated {pdf_file}")
+            else:
+                print(f"Error generating {pdf_file}: {error}")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    if generated or fetch_counts:
+        print(f"PDF assets: {format_fetch_counts(fetch_counts)}")
+    return generated
+
+
+# Define the cash flow statement structure with independent vs dependent values
+CASH_FLOW_STRUCTURE = {
+    # Independent values (to be randomized)
+    'independent': {
+        # Starting point
+        'net_income': 'us-gaap:NetIncomeLoss',
+
+        # Operating activities adjustments
+        'depreciation': 'us-gaap:DepreciationDepletionAndAmortization',
+        'share_based_comp': 'us-gaap:ShareBasedCompensation',
+        'deferred_tax': 'us-gaap:DeferredIncomeTaxExpenseBenefit',
+
+        # Working capital changes
+        'accounts_receivable': 'us-gaap:IncreaseDecreaseInAccountsReceivable',
+        'accounts_payable': 'us-gaap:IncreaseDecreaseInAccountsPayable',
+
+        # Investing activities
+        'payments_securities': 'us-gaap:PaymentsToAcquireAvailableForSaleSecuritiesDebt',
+        'proceeds_securities': 'us-gaap:ProceedsFromSaleOfAvailableForSaleSecuritiesDebt',
+        'capex': 'us-gaap:PaymentsToAcquirePropertyPlantAndEquipment',
+        'business_acquisitions': 'us-gaap:PaymentsToAcquireBusinessesNetOfCashAcquired',
+        'other_investing': 'us-gaap:PaymentsForProceedsFromOtherInvestingActivities',
+
+        # Financing activities
+        'debt_proceeds': 'us-gaap:ProceedsFromIssuanceOfLongTermDebt',
+        'share_repurchases': 'us-gaap:PaymentsForRepurchaseOfCommonStock',
+        'dividends': 'us-gaap:PaymentsOfDividends',
+        'tax_withholding': 'us-gaap:PaymentsRelatedToTaxWithholdingForShareBasedCompensation',
+        'other_financing': 'us-gaap:ProceedsFromPaymentsForOtherFinancingActivities',
+
+        # Beginning cash balance (independent - this is the starting point)
+        'beginning_cash': 'us-gaap:CashCashEquivalentsRestrictedCashAndRestrictedCashEquivalents'
+    },
+
+    # Dependent values (to be calculated)
+    'dependent': {
+        'operating_total': 'us-gaap:NetCashProvidedByUsedInOperatingActivities',
+        'investing_total': 'us-gaap:NetCashProvidedByUsedInInvestingActivities', 
+        'financing_total': 'us-gaap:NetCashProvidedByUsedInFinancingActivities',
+        'cash_change': 'us-gaap:CashCashEquivalentsRestrictedCashAndRestrictedCashEquivalentsPeriodIncreaseDecreaseIncludingExchangeRateEffect',
+        'ending_cash': 'us-gaap:CashCashEquivalentsRestrictedCashAndRestrictedCashEquivalents'  # This appears twice - end of period
+    }
+}
+
+
+def read_input_file(input_file):
+    """Read an input HTML file, falling back to windows-1252 for full EDGAR filings"""
+    try:
+        with open(input_file, 'r', encoding='utf-8') as file:
+            return file.read()
+    except UnicodeDecodeError:
+        # Full EDGAR filings are saved as windows-1252
+        with open(input_file, 'r', encoding='windows-1252', errors='replace') as file:
+            return file.read()
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Input file '{input_file}' not found")
+
+
+def compile_document(input_file='aapl_p33.html'):
     """
-    Scramble financial data from an XBRL HTML file while maintaining accounting relationships.
-    
+    Parse an XBRL HTML file once into everything needed to generate variants.
+
     Args:
-        generate_file_count (int): Number of randomized files to generate (default: 10)
         input_file (str): Path to the input HTML file (default: 'aapl_p33.html')
-    
+
     Returns:
-        dict: Summary of generated files and statistics
+        dict: Template segments and slot plan, original independent values,
+              dependent-value model, JSON plan and the columnar fact table
     """
     # Dictionary to store original values and their placeholders
     value_map = {}
     placeholder_counter = 1
     
-    # Dictionary to store extracted values for calculations
-    extracted_values = {}
+    # (fact, placeholder, is_dependent) for every scrambled fact, in document order
+    scrambled_facts = []
     
-    # Read the original HTML file
-    try:
-        with open(input_file, 'r', encoding='utf-8') as file:
-            html_content = file.read()
-    except FileNotFoundError:
-        raise FileNotFoundError(f"Input file '{input_file}' not found")
+    # Placeholder of each independent fact, so a fact shown more than once
+    # (same tag, context and text) gets the same value everywhere
+    fact_placeholders = {}
     
-    # Define the cash flow statement structure with independent vs dependent values
-    CASH_FLOW_STRUCTURE = {
-        # Independent values (to be randomized)
-        'independent': {
-            # Starting point
-            'net_income': 'us-gaap:NetIncomeLoss',
-            
-            # Operating activities adjustments
-            'depreciation': 'us-gaap:DepreciationDepletionAndAmortization',
-            'share_based_comp': 'us-gaap:ShareBasedCompensation',
-            'deferred_tax': 'us-gaap:DeferredIncomeTaxExpenseBenefit',
-            
-            # Working capital changes
-            'accounts_receivable': 'us-gaap:IncreaseDecreaseInAccountsReceivable',
-            'accounts_payable': 'us-gaap:IncreaseDecreaseInAccountsPayable',
-            
-            # Investing activities
-            'payments_securities': 'us-gaap:PaymentsToAcquireAvailableForSaleSecuritiesDebt',
-            'proceeds_securities': 'us-gaap:ProceedsFromSaleOfAvailableForSaleSecuritiesDebt',
-            'capex': 'us-gaap:PaymentsToAcquirePropertyPlantAndEquipment',
-            'business_acquisitions': 'us-gaap:PaymentsToAcquireBusinessesNetOfCashAcquired',
-            'other_investing': 'us-gaap:PaymentsForProceedsFromOtherInvestingActivities',
-            
-            # Financing activities
-            'debt_proceeds': 'us-gaap:ProceedsFromIssuanceOfLongTermDebt',
-            'share_repurchases': 'us-gaap:PaymentsForRepurchaseOfCommonStock',
-            'dividends': 'us-gaap:PaymentsOfDividends',
-            'tax_withholding': 'us-gaap:PaymentsRelatedToTaxWithholdingForShareBasedCompensation',
-            'other_financing': 'us-gaap:ProceedsFromPaymentsForOtherFinancingActivities',
-            
-            # Beginning cash balance (independent - this is the starting point)
-            'beginning_cash': 'us-gaap:CashCashEquivalentsRestrictedCashAndRestrictedCashEquivalents'
-        },
-        
-        # Dependent values (to be calculated)
-        'dependent': {
-            'operating_total': 'us-gaap:NetCashProvidedByUsedInOperatingActivities',
-            'investing_total': 'us-gaap:NetCashProvidedByUsedInInvestingActivities', 
-            'financing_total': 'us-gaap:NetCashProvidedByUsedInFinancingActivities',
-            'cash_change': 'us-gaap:CashCashEquivalentsRestrictedCashAndRestrictedCashEquivalentsPeriodIncreaseDecreaseIncludingExchangeRateEffect',
-            'ending_cash': 'us-gaap:CashCashEquivalentsRestrictedCashAndRestrictedCashEquivalents'  # This appears twice - end of period
-        }
-    }
+    # Every ix:nonfraction fact of the document, in document order
+    facts = []
+    
+    # Read the original HTML file
+    html_content = read_input_file(input_file)
 
-    # Function to check if a number should be excluded (dates, years in headers, CSS values)
-    def should_exclude_number(number_str, context_before, context_after):
-        """Check if a number should be excluded from scrambling (e.g., dates, years in headers, CSS values)"""
+    # Function to check if a number should be excluded (dates, years in headers)
+    def should_exclude_number(number_str, content, start, end):
+        """Check if a number should be excluded from scrambling (e.g., dates, years in headers)"""
         
         # Remove commas for checking
         clean_number = number_str.replace(',', '')
+        if not clean_number.isdigit():
+            return False
+        number = int(clean_number)
         
         # Exclude years in the 2020s range (2020-2029)
-        if clean_number.isdigit() and 2020 <= int(clean_number) <= 2029:
+        if 2020 <= number <= 2029:
             return True
         
         # Exclude years in the 2010s range (2010-2019) - might be in historical data
-        if clean_number.isdigit() and 2010 <= int(clean_number) <= 2019:
+        if 2010 <= number <= 2019:
             return True
         
         # Exclude day numbers (1-31) when they appear in date contexts
-        if clean_number.isdigit() and 1 <= int(clean_number) <= 31:
-            # Check for date-related context
-            context = (context_before + context_after).lower()
-            if any(month in context for month in ['january', 'february', 'march', 'april', 'may', 'june',
-                                                'july', 'august', 'september', 'october', 'november', 'december']):
-                return True
-        
-        # Only exclude CSS styling values if the number is DIRECTLY part of a CSS property
-        # Check the immediate context (±50 chars) for CSS property patterns
-        immediate_before = context_before[-50:]
-        immediate_after = context_after[:50]
-        
-        # Pattern: property:value (where our number is the value)
-        css_property_pattern = r'(width|height|margin|padding|font-size|line-height|top|left|right|bottom|border|text-indent|min-height|max-width|max-height|min-width):\s*$'
-        if re.search(css_property_pattern, immediate_before):
-            return True
-        
-        # Exclude percentage values in CSS (number immediately followed by %)
-        if immediate_after.startswith('%'):
-            return True
-        
-        # Exclude pt, px, em values in CSS
-        if re.match(r'^(pt|px|em)', immediate_after):
-            return True
+        if 1 <= number <= 31:
+            # Check for date-related context around the number
+            context = content[max(0, start - 500):end + 200]
+            return MONTH_PATTERN.search(context) is not None
         
         return False
 
@@ -127,733 +1359,1100 @@ def scramble_financial_data(generate_file_count=10, input_file='aapl_p33.html'):
         placeholder_counter += 1
         return placeholder
 
-    def generate_random_value(original_value, value_type):
-        """Generate a realistic random value based on the original"""
-        # Remove commas and convert to integer
-        clean_value = original_value.replace(',', '')
-        
-        try:
-            original_num = int(clean_value)
-            
-            # Generate variation based on magnitude
-            if abs(original_num) < 1000:
-                # Small numbers: ±50% variation
-                variation_range = max(100, int(abs(original_num) * 0.5))
-            elif abs(original_num) < 10000:
-                # Medium numbers: ±40% variation
-                variation_range = int(abs(original_num) * 0.4)
-            else:
-                # Large numbers: ±30% variation
-                variation_range = int(abs(original_num) * 0.3)
-            
-            # Apply random variation
-            variation = random.randint(-variation_range, variation_range)
-            new_value = original_num + variation
-            
-            # Ensure we don't flip the sign for large positive numbers
-            if original_num > 10000 and new_value < 0:
-                new_value = abs(new_value)
-            
-            # Format with commas if original had them
-            if ',' in original_value:
-                return f"{new_value:,}"
-            else:
-                return str(new_value)
-        
-        except ValueError:
-            return original_value
-
     def is_dependent_value(xbrl_tag):
         """Check if an XBRL tag represents a dependent (calculated) value"""
         dependent_tags = set(CASH_FLOW_STRUCTURE['dependent'].values())
         return xbrl_tag in dependent_tags
 
-    def extract_xbrl_tag(context):
-        """Extract the XBRL tag name from the context"""
-        match = re.search(r'name="([^"]+)"', context)
-        return match.group(1) if match else None
-
     def process_html_content(content):
         """Process HTML content, identifying independent vs dependent values"""
-        processed_content = content
+        pieces = []
+        last_end = 0
         
-        # Pattern for XBRL financial values
-        def replace_financial_values(match):
-            full_match = match.group(0)
-            number = match.group(1)
-            
-            # Get context around the match to extract XBRL tag
-            start_pos = max(0, match.start() - 500)
-            end_pos = min(len(content), match.end() + 200)
-            context_before = content[start_pos:match.start()]
-            context_after = content[match.end():end_pos]
+        facts.extend(extract_facts(content))
+        for fact in facts:
+            # Template slot holding this fact's value, if it gets scrambled
+            fact['slot'] = None
+            number = fact['text']
+            if not NUMBER_PATTERN.fullmatch(number):
+                continue
             
             # Check exclusion criteria first
-            if should_exclude_number(number, context_before, context_after):
-                return full_match
-            
-            # Extract XBRL tag
-            xbrl_tag = extract_xbrl_tag(context_before + full_match + context_after)
+            if should_exclude_number(number, content, fact['start'], fact['end']):
+                continue
             
+            xbrl_tag = fact['name']
             if not xbrl_tag:
-                return full_match
+                continue
                 
-            # Store the original value for later calculations
-            key = f"{xbrl_tag}_{number}"
-            extracted_values[key] = {
-                'tag': xbrl_tag,
-                'original_value': number,
-                'is_dependent': is_dependent_value(xbrl_tag),
-                'placeholder': None,
-                'calculated_value': None
-            }
-            
             # Only create placeholders for independent values
-            if not is_dependent_value(xbrl_tag):
-                placeholder = create_placeholder(number, 'financial_value')
-                extracted_values[key]['placeholder'] = placeholder
-                return full_match.replace(number, placeholder)
+            is_dependent = is_dependent_value(xbrl_tag)
+            if not is_dependent:
+                fact_key = (xbrl_tag, fact['contextref'], number)
+                if fact_key not in fact_placeholders:
+                    fact_placeholders[fact_key] = create_placeholder(number, 'financial_value')
+                placeholder = fact_placeholders[fact_key]
             else:
                 # For dependent values, create a special marker that will be replaced with calculated values
-                calc_placeholder = f"{{{{CALC_{len(extracted_values)}_{xbrl_tag.split(':')[-1].upper()}}}}}"
-                extracted_values[key]['placeholder'] = calc_placeholder
-                return full_match.replace(number, calc_placeholder)
-        
-        # Apply to both comma numbers and plain numbers in XBRL tags
-        processed_content = re.sub(r'>([0-9]{1,3}(?:,[0-9]{3})+)</ix:nonfraction>', replace_financial_values, processed_content)
-        processed_content = re.sub(r'>([0-9]+)</ix:nonfraction>', replace_financial_values, processed_content)
-        
-        return processed_content
-
-    def calculate_dependent_values(randomized_independent_values):
-        """Calculate dependent values based on randomized independent values"""
-        calculated = {}
-        
-        # Helper function to get values by tag (returns list of values for all years)
-        def get_values_by_tag(tag_name):
-            values = []
-            for key, data in extracted_values.items():
-                if data['tag'] == tag_name and not data['is_dependent']:
-                    placeholder = data['placeholder']
-                    if placeholder in randomized_independent_values:
-                        value_str = randomized_independent_values[placeholder]
-                        values.append(int(value_str.replace(',', '')))
-            return values
-        
-        # Get all independent values (should be 3 values each - one per year)
-        net_income_values = get_values_by_tag('us-gaap:NetIncomeLoss')
-        depreciation_values = get_values_by_tag('us-gaap:DepreciationDepletionAndAmortization')
-        share_comp_values = get_values_by_tag('us-gaap:ShareBasedCompensation')
-        deferred_tax_values = get_values_by_tag('us-gaap:DeferredIncomeTaxExpenseBenefit')
-        ar_change_values = get_values_by_tag('us-gaap:IncreaseDecreaseInAccountsReceivable')
-        ap_change_values = get_values_by_tag('us-gaap:IncreaseDecreaseInAccountsPayable')
-        
-        # Get other operating activities values
-        inventory_values = get_values_by_tag('us-gaap:IncreaseDecreaseInInventories')
-        other_receivables_values = get_values_by_tag('us-gaap:IncreaseDecreaseInOtherReceivables')
-        other_assets_values = get_values_by_tag('us-gaap:IncreaseDecreaseInOtherOperatingAssets')
-        deferred_revenue_values = get_values_by_tag('us-gaap:IncreaseDecreaseInContractWithCustomerLiability')
-        other_liabilities_values = get_values_by_tag('us-gaap:IncreaseDecreaseInOtherOperatingLiabilities')
-        other_noncash_values = get_values_by_tag('us-gaap:OtherNoncashIncomeExpense')
-        
-        # Get investing activities components
-        payments_securities_values = get_values_by_tag('us-gaap:PaymentsToAcquireAvailableForSaleSecuritiesDebt')
-        proceeds_securities_values = get_values_by_tag('us-gaap:ProceedsFromSaleOfAvailableForSaleSecuritiesDebt')
-        proceeds_maturities_values = get_values_by_tag('us-gaap:ProceedsFromMaturitiesPrepaymentsAndCallsOfAvailableForSaleSecurities')
-        capex_values = get_values_by_tag('us-gaap:PaymentsToAcquirePropertyPlantAndEquipment')
-        acquisitions_values = get_values_by_tag('us-gaap:PaymentsToAcquireBusinessesNetOfCashAcquired')
-        other_investing_values = get_values_by_tag('us-gaap:PaymentsForProceedsFromOtherInvestingActivities')
-        
-        # Get financing activities components
-        debt_proceeds_values = get_values_by_tag('us-gaap:ProceedsFromIssuanceOfLongTermDebt')
-        debt_repayments_values = get_values_by_tag('us-gaap:RepaymentsOfLongTermDebt')
-        share_repurchases_values = get_values_by_tag('us-gaap:PaymentsForRepurchaseOfCommonStock')
-        dividends_values = get_values_by_tag('us-gaap:PaymentsOfDividends')
-        tax_withholding_values = get_values_by_tag('us-gaap:PaymentsRelatedToTaxWithholdingForShareBasedCompensation')
-        commercial_paper_values = get_values_by_tag('us-gaap:ProceedsFromRepaymentsOfCommercialPaper')
-        other_financing_values = get_values_by_tag('us-gaap:ProceedsFromPaymentsForOtherFinancingActivities')
-        
-        # Get beginning cash values (should be independent)
-        beginning_cash_values = get_values_by_tag('us-gaap:CashCashEquivalentsRestrictedCashAndRestrictedCashEquivalents')
-        
-        # Calculate for each year (assuming we have 3 years of data)
-        num_years = max(len(net_income_values), 3)
-        
-        for year_idx in range(num_years):
-            # Helper to safely get value from list
-            def safe_get(values_list, idx, default=0):
-                if idx < len(values_list):
-                    return values_list[idx]
-                return default
-            
-            # Get values for this year
-            net_income = safe_get(net_income_values, year_idx)
-            depreciation = safe_get(depreciation_values, year_idx)
-            share_comp = safe_get(share_comp_values, year_idx)
-            deferred_tax = safe_get(deferred_tax_values, year_idx)
-            ar_change = safe_get(ar_change_values, year_idx)
-            ap_change = safe_get(ap_change_values, year_idx)
-            
-            # Get other operating components
-            inventory = safe_get(inventory_values, year_idx)
-            other_receivables = safe_get(other_receivables_values, year_idx)
-            other_assets = safe_get(other_assets_values, year_idx)
-            deferred_revenue = safe_get(deferred_revenue_values, year_idx)
-            other_liabilities = safe_get(other_liabilities_values, year_idx)
-            other_noncash = safe_get(other_noncash_values, year_idx)
-            
-            # Calculate Operating Activities Total for this year
-            operating_total = (net_income + depreciation + share_comp + deferred_tax + 
-                              ar_change + ap_change + inventory + other_receivables + 
-                              other_assets + deferred_revenue + other_liabilities + other_noncash)
-            
-            # Get investing components for this year
-            payments_securities = safe_get(payments_securities_values, year_idx)
-            proceeds_securities = safe_get(proceeds_securities_values, year_idx)
-            proceeds_maturities = safe_get(proceeds_maturities_values, year_idx)
-            capex = safe_get(capex_values, year_idx)
-            acquisitions = safe_get(acquisitions_values, year_idx)
-            other_investing = safe_get(other_investing_values, year_idx)
-            
-            # Calculate Investing Activities Total for this year (note: payments are typically negative)
-            investing_total = (proceeds_securities + proceeds_maturities - payments_securities - 
-                              capex - acquisitions - other_investing)
-            
-            # Get financing components for this year
-            debt_proceeds = safe_get(debt_proceeds_values, year_idx)
-            debt_repayments = safe_get(debt_repayments_values, year_idx)
-            share_repurchases = safe_get(share_repurchases_values, year_idx)
-            dividends = safe_get(dividends_values, year_idx)
-            tax_withholding = safe_get(tax_withholding_values, year_idx)
-            commercial_paper = safe_get(commercial_paper_values, year_idx)
-            other_financing = safe_get(other_financing_values, year_idx)
+                placeholder = f"{{{{CALC_{len(scrambled_facts) + 1}_{xbrl_tag.split(':')[-1].upper()}}}}}"
+            fact['slot'] = len(pieces) // 2
             
-            # Calculate Financing Activities Total for this year (note: most are negative cash flows)
-            financing_total = (debt_proceeds - debt_repayments - share_repurchases - 
-                              dividends - tax_withholding + commercial_paper + other_financing)
-            
-            # Calculate overall cash change
-            cash_change = operating_total + investing_total + financing_total
+            # Store the original value for later calculations
+            scrambled_facts.append((fact, placeholder, is_dependent))
             
-            # Store calculated values with year-specific keys
-            calculated[f'us-gaap:NetCashProvidedByUsedInOperatingActivities_{year_idx}'] = operating_total
-            calculated[f'us-gaap:NetCashProvidedByUsedInInvestingActivities_{year_idx}'] = investing_total
-            calculated[f'us-gaap:NetCashProvidedByUsedInFinancingActivities_{year_idx}'] = financing_total
-            calculated[f'us-gaap:CashCashEquivalentsRestrictedCashAndRestrictedCashEquivalentsPeriodIncreaseDecreaseIncludingExchangeRateEffect_{year_idx}'] = cash_change
+            pieces.append(content[last_end:fact['start']])
+            pieces.append(placeholder)
+            last_end = fact['end']
         
-        return calculated
+        pieces.append(content[last_end:])
+        return ''.join(pieces)
 
-    def extract_financial_data_from_html(html_file):
-        """Extract financial data from generated HTML and format as required"""
-        with open(html_file, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # Define the cash flow statement structure with XBRL tag mappings
-        cash_flow_structure = [
-            # Headers
-            ("", "", "Years ended", ""),
-            ("", "September 24, 2022", "September 25, 2021", "September 26, 2020"),
-            
-            # Cash beginning balances
-            ("Cash, cash equivalents and restricted cash, beginning balances", "us-gaap:CashCashEquivalentsRestrictedCashAndRestrictedCashEquivalents", True),
-            
-            # Operating activities section
-            ("Operating activities:", "", "", ""),
-            ("Net income", "us-gaap:NetIncomeLoss", False),
-            ("Adjustments to reconcile net income to cash generated by operating activities:", "", "", ""),
-            ("Depreciation and amortization", "us-gaap:DepreciationDepletionAndAmortization", False),
-            ("Share-based compensation expense", "us-gaap:ShareBasedCompensation", False),
-            ("Deferred income tax expense/(benefit)", "us-gaap:DeferredIncomeTaxExpenseBenefit", False),
-            ("Other", "us-gaap:OtherNoncashIncomeExpense", False),
-            ("Changes in operating assets and liabilities:", "", "", ""),
-            ("Accounts receivable, net", "us-gaap:IncreaseDecreaseInAccountsReceivable", True),
-            ("Inventories", "us-gaap:IncreaseDecreaseInInventories", True),
-            ("Vendor non-trade receivables", "us-gaap:IncreaseDecreaseInOtherReceivables", True),
-            ("Other current and non-current assets", "us-gaap:IncreaseDecreaseInOtherOperatingAssets", True),
-            ("Accounts payable", "us-gaap:IncreaseDecreaseInAccountsPayable", False),
-            ("Deferred revenue", "us-gaap:IncreaseDecreaseInContractWithCustomerLiability", False),
-            ("Other current and non-current liabilities", "us-gaap:IncreaseDecreaseInOtherOperatingLiabilities", False),
-            ("Cash generated by operating activities", "us-gaap:NetCashProvidedByUsedInOperatingActivities", False),
-            
-            # Investing activities section
-            ("Investing activities:", "", "", ""),
-            ("Purchases of marketable securities", "us-gaap:PaymentsToAcquireMarketableSecurities", True),
-            ("Proceeds from maturities of marketable securities", "us-gaap:ProceedsFromMaturitiesPrepaymentsAndCallsOfAvailableForSaleSecurities", False),
-            ("Proceeds from sales of marketable securities", "us-gaap:ProceedsFromSaleOfAvailableForSaleSecuritiesDebt", False),
-            ("Payments for acquisition of property, plant and equipment", "us-gaap:PaymentsToAcquirePropertyPlantAndEquipment", True),
-            ("Payments made in connection with business acquisitions, net", "us-gaap:PaymentsToAcquireBusinessesNetOfCashAcquired", True),
-            ("Other", "us-gaap:PaymentsForProceedsFromOtherInvestingActivities", True),
-            ("Cash used in investing activities", "us-gaap:NetCashProvidedByUsedInInvestingActivities", True),
-            
-            # Financing activities section
-            ("Financing activities:", "", "", ""),
-            ("Payments for taxes related to net share settlement of equity awards", "us-gaap:PaymentsRelatedToTaxWithholdingForShareBasedCompensation", True),
-            ("Payments for dividends and dividend equivalents", "us-gaap:PaymentsOfDividends", True),
-            ("Repurchases of common stock", "us-gaap:PaymentsForRepurchaseOfCommonStock", True),
-            ("Proceeds from issuance of term debt, net", "us-gaap:ProceedsFromIssuanceOfLongTermDebt", False),
-            ("Repayments of term debt", "us-gaap:RepaymentsOfLongTermDebt", True),
-            ("Proceeds from/(Repayments of) commercial paper, net", "us-gaap:ProceedsFromRepaymentsOfCommercialPaper", False),
-            ("Other", "us-gaap:ProceedsFromPaymentsForOtherFinancingActivities", False),
-            ("Cash used in financing activities", "us-gaap:NetCashProvidedByUsedInFinancingActivities", True),
-            
-            # Cash change and ending balance
-            ("Decrease in cash, cash equivalents and restricted cash", "us-gaap:CashCashEquivalentsRestrictedCashAndRestrictedCashEquivalentsPeriodIncreaseDecreaseIncludingExchangeRateEffect", True),
-            ("Cash, cash equivalents and restricted cash, ending balances", "us-gaap:CashCashEquivalentsRestrictedCashAndRestrictedCashEquivalentsEnding", True),  # ending balance
-            
-            # Supplemental disclosures
-            ("Supplemental cash flow disclosure:", "", "", ""),
-            ("Cash paid for income taxes, net", "us-gaap:IncomeTaxesPaid", False),
-            ("Cash paid for interest", "us-gaap:InterestPaidNet", False)
-        ]
-        
-        def extract_values_by_tag(tag_name, count=3):
-            """Extract values for a specific XBRL tag (up to 3 years)"""
-            pattern = f'name="{tag_name}"[^>]*>([0-9,]+)</ix:nonfraction>'
-            matches = re.findall(pattern, content)
-            return matches[:count] if matches else []
-        
-        def format_value(value_str, is_negative_item=False, add_dollar=False):
-            """Format value with proper dollar signs and parentheses"""
-            if not value_str or value_str == "":
-                return ""
-                
-            # Remove commas for processing
-            clean_value = value_str.replace(',', '')
-            
-            # Check if it's a number
-            try:
-                num_value = int(clean_value)
-                # Add commas back
-                formatted = f"{abs(num_value):,}"
-                
-                # Add parentheses for negative items or negative values
-                if is_negative_item or num_value < 0:
-                    formatted = f"({formatted})"
-                
-                # Add dollar sign if required
-                if add_dollar:
-                    formatted = f"$ {formatted}"
-                    
-                return formatted
-            except:
-                return value_str
-        
-        # Build the JSON data structure
-        json_data = []
-        
-        for row in cash_flow_structure:
-            if len(row) == 4:
-                # Header row
-                json_data.append(list(row))
-            elif len(row) == 3:
-                label, tag, is_negative = row
-                
-                if tag == "" or not tag:
-                    # Section header - empty values
-                    json_data.append([label, "", "", ""])
+    def plan_slots(slots, calculated_keys, fact_table):
+        """
+        Decide once, in document order, what each template slot is filled with.
+
+        Independent placeholders first, then calculated totals year by year
+        (every fact of a tag and period takes that year's total), then ending
+        cash balances, then any leftover CALC placeholders.
+        """
+        slot_plan = [None] * len(slots)
+        slot_indexes = {}
+        for slot_idx, placeholder in enumerate(slots):
+            slot_indexes.setdefault(placeholder, []).append(slot_idx)
+
+        # Independent values replace every occurrence of their placeholder
+        for placeholder in value_map:
+            for slot_idx in slot_indexes.get(placeholder, []):
+                slot_plan[slot_idx] = ('independent', placeholder)
+
+        # Dependent facts take their tag's total for the year of their period, latest first
+        # Membership only: the ordered list decides the investing fallback below
+        calculated_key_set = set(calculated_keys)
+        dependent_tags = dict.fromkeys(fact_table['tags'][tag_id] for tag_id in
+                                       fact_table['tag_ids'][fact_table['dependent']].tolist())
+        for tag in dependent_tags:
+            for year_idx, period in enumerate(tag_periods(fact_table, tag)):
+                year_key = f"{tag}_{year_idx}"
+                if year_key in calculated_key_set:
+                    for row in fact_rows(fact_table, tag, period).tolist():
+                        slot_plan[fact_table['slots'][row]] = ('calculated', year_key)
+
+        # Cash balance placeholders take the ending cash of the matching year
+        if beginning_cash_values:
+            cash_slots = [slot_idx for slot_idx, placeholder in enumerate(slots)
+                          if slot_plan[slot_idx] is None and CASH_BALANCE_PLACEHOLDER_PATTERN.fullmatch(placeholder)]
+            for j, slot_idx in enumerate(cash_slots[:len(beginning_cash_values[:3])]):
+                slot_plan[slot_idx] = ('calculated', f"{ENDING_CASH_TAG}_ending_{j}")
+
+        # Any remaining CALC placeholders get a reasonable value
+        investing_key = next((key for key in calculated_keys
+                              if 'NetCashProvidedByUsedInInvestingActivities' in key), None)
+        for slot_idx, placeholder in enumerate(slots):
+            if slot_plan[slot_idx] is None:
+                if 'INVESTING' in placeholder:
+                    slot_plan[slot_idx] = ('investing', investing_key)
                 else:
-                    # Extract values for this tag
-                    values = extract_values_by_tag(tag)
-                    
-                    # Special handling for ending cash balances and supplemental disclosures
-                    if "ending balances" in label.lower():
-                        # For ending cash, try multiple tag patterns and ensure positive values
-                        if not values:
-                            # Try alternative patterns for ending cash
-                            alt_patterns = [
-                                "us-gaap:CashCashEquivalentsRestrictedCashAndRestrictedCashEquivalents",
-                                "us-gaap:CashAndCashEquivalentsAtCarryingValue"
-                            ]
-                            for alt_tag in alt_patterns:
-                                values = extract_values_by_tag(alt_tag)
-                                if values:
-                                    break
-                        
-                        # Extract ending cash values from the end of the file (latest values)
-                        if values and len(values) >= 3:
-                            # Take the last 3 values as they represent ending balances
-                            values = values[-3:]
-                        
-                    elif "cash paid for income taxes" in label.lower():
-                        # Try alternative tags for income taxes
-                        if not values:
-                            alt_tags = ["us-gaap:IncomeTaxesPaidNet", "us-gaap:CashPaidForIncomeTaxes"]
-                            for alt_tag in alt_tags:
-                                values = extract_values_by_tag(alt_tag)
-                                if values:
-                                    break
-                    
-                    elif "cash paid for interest" in label.lower():
-                        # Try alternative tags for interest paid
-                        if not values:
-                            alt_tags = ["us-gaap:InterestPaid", "us-gaap:CashPaidForInterest"]
-                            for alt_tag in alt_tags:
-                                values = extract_values_by_tag(alt_tag)
-                                if values:
-                                    break
-                    
-                    # Determine if dollar signs are needed (cash balances and supplemental items)
-                    add_dollar = ("cash" in label.lower() and "balances" in label.lower()) or ("cash paid" in label.lower())
-                    
-                    # Format the values
-                    formatted_values = []
-                    if len(values) >= 3:
-                        for i in range(3):
-                            formatted_values.append(format_value(values[i], is_negative, add_dollar))
-                    else:
-                        # Generate reasonable fallback values for missing data
-                        if "cash paid for income taxes" in label.lower():
-                            # Generate reasonable tax values
-                            fallback_values = ["19,000", "24,000", "9,000"]
-                            formatted_values = [format_value(val, False, True) for val in fallback_values]
-                        elif "cash paid for interest" in label.lower():
-                            # Generate reasonable interest values 
-                            fallback_values = ["2,800", "2,600", "2,900"]
-                            formatted_values = [format_value(val, False, True) for val in fallback_values]
-                        else:
-                            formatted_values = ["", "", ""]
-                    
-                    json_data.append([label] + formatted_values)
-        
-        return json_data
+                    slot_plan[slot_idx] = ('random', None)
+
+        return slot_plan
 
-    # Main processing logic
-    print("Processing HTML content...")
     processed_content = process_html_content(html_content)
+    fact_table = build_fact_table(scrambled_facts)
 
-    independent_count = sum(1 for v in extracted_values.values() if not v['is_dependent'])
-    dependent_count = sum(1 for v in extracted_values.values() if v['is_dependent'])
+    # Beginning cash values, one per year - 2022, 2021, 2020
+    beginning_cash_values = []
+    for period in tag_periods(fact_table, ENDING_CASH_TAG):
+        row = fact_rows(fact_table, ENDING_CASH_TAG, period)[0]
+        if not fact_table['dependent'][row]:
+            beginning_cash_values.append(int(fact_table['values'][row]))
 
-    print(f"Found {independent_count} independent values to randomize")
-    print(f"Found {dependent_count} dependent values to calculate")
+    # Compile the processed document once; every variant is a single join over it
+    segments, slots = compile_template(processed_content)
 
-    # Create output directories
-    os.makedirs('html_out', exist_ok=True)
-    os.makedirs('json_out', exist_ok=True)
-    os.makedirs('pdf_out', exist_ok=True)
+    # Column of each independent value in the sampled matrix: the first fact of
+    # every tag and period, latest year first
+    placeholders = list(value_map)
+    column_index = {placeholder: idx for idx, placeholder in enumerate(placeholders)}
+    columns_by_tag = {}
+    for tag in fact_table['by_tag']['ranges']:
+        for period in tag_periods(fact_table, tag):
+            row = int(fact_rows(fact_table, tag, period)[0])
+            if not fact_table['dependent'][row]:
+                columns_by_tag.setdefault(tag, []).append(column_index[fact_table['placeholders'][row]])
+    dependent_model = build_dependent_model(columns_by_tag, len(placeholders), beginning_cash_values)
+    slot_plan = plan_slots(slots, dependent_model['keys'], fact_table)
 
-    # Generate randomized versions with proper calculations
-    generated_files = {'html': [], 'json': [], 'pdf': []}
-    
-    for i in range(1, generate_file_count + 1):
-        # Create a copy of the processed content
-        randomized_content = processed_content
-        
-        # First, replace independent values with random values
-        randomized_independent_values = {}
-        for placeholder, (original_value, value_type) in value_map.items():
-            random_value = generate_random_value(original_value, value_type)
-            randomized_independent_values[placeholder] = random_value
-            randomized_content = randomized_content.replace(placeholder, random_value)
-        
-        # Calculate dependent values
-        calculated_values = calculate_dependent_values(randomized_independent_values)
-        
-        # Group dependent values by tag for proper year-based replacement
-        dependent_by_tag = {}
-        for key, data in extracted_values.items():
-            if data['is_dependent']:
-                tag = data['tag']
-                if tag not in dependent_by_tag:
-                    dependent_by_tag[tag] = []
-                dependent_by_tag[tag].append(data)
-        
-        # Replace calculated value placeholders year by year
-        for tag, dependent_list in dependent_by_tag.items():
-            # Sort by original value to maintain year order (highest to lowest typically)
-            dependent_list.sort(key=lambda x: int(x['original_value'].replace(',', '')), reverse=True)
-            
-            for year_idx, data in enumerate(dependent_list):
-                if data['placeholder']:
-                    placeholder = data['placeholder']
-                    year_key = f"{tag}_{year_idx}"
-                    
-                    if year_key in calculated_values:
-                        calc_value = calculated_values[year_key]
-                        # Format with commas and handle negative values
-                        if calc_value < 0:
-                            formatted_value = f"{abs(calc_value):,}"
-                        else:
-                            formatted_value = f"{calc_value:,}"
-                        
-                        # Replace this specific occurrence
-                        randomized_content = randomized_content.replace(placeholder, formatted_value, 1)
-        
-        # Handle ending cash balance calculations (these need beginning cash + cash change)
-        # Find beginning cash values and calculate ending cash
-        beginning_cash_placeholders = []
-        for key, data in extracted_values.items():
-            if (data['tag'] == 'us-gaap:CashCashEquivalentsRestrictedCashAndRestrictedCashEquivalents' and
-                not data['is_dependent']):
-                beginning_cash_placeholders.append((int(data['original_value'].replace(',', '')), data))
-        
-        # Sort by value (highest to lowest for years - 2022, 2021, 2020)
-        beginning_cash_placeholders.sort(key=lambda x: x[0], reverse=True)
-        
-        # Calculate ending cash balances for each year
-        if beginning_cash_placeholders:
-            # Get cash change values for each year
-            cash_change_values = []
-            for year_idx in range(3):  # 3 years of data
-                cash_change_key = f'us-gaap:CashCashEquivalentsRestrictedCashAndRestrictedCashEquivalentsPeriodIncreaseDecreaseIncludingExchangeRateEffect_{year_idx}'
-                if cash_change_key in calculated_values:
-                    cash_change_values.append(calculated_values[cash_change_key])
-                else:
-                    # Fallback: use a reasonable negative change
-                    cash_change_values.append(-15000 - (year_idx * 5000))
-            
-            # Calculate ending cash for each year
-            ending_cash_values = []
-            for year_idx, (beginning_cash, _) in enumerate(beginning_cash_placeholders[:3]):
-                if year_idx < len(cash_change_values):
-                    ending_cash = beginning_cash + cash_change_values[year_idx]
-                    ending_cash_values.append(max(ending_cash, 10000))  # Ensure positive values
-                else:
-                    ending_cash_values.append(beginning_cash - 15000)  # Default fallback
-            
-            # Replace cash balance placeholders with calculated values
-            cash_pattern = r'{{CALC_\d+_CASHCASHEQUIVALENTSRESTRICTEDCASHANDRESTRICTEDCASHEQUIVALENTS}}'
-            matches = re.findall(cash_pattern, randomized_content)
-            
-            # Replace each match with the corresponding year's ending cash
-            for j, match in enumerate(matches):
-                if j < len(ending_cash_values):
-                    ending_cash_formatted = f"{ending_cash_values[j]:,}"
-                    randomized_content = randomized_content.replace(match, ending_cash_formatted, 1)
-        
-        # Handle any remaining unreplaced CALC placeholders
-        remaining_calc_pattern = r'{{CALC_\d+_[^}]+}}'
-        remaining_matches = re.findall(remaining_calc_pattern, randomized_content)
-        
-        for match in remaining_matches:
-            # For any remaining placeholders, replace with a reasonable calculated value
-            # These are likely other investment or financing calculations
-            if 'INVESTING' in match:
-                # Use one of the calculated investing totals
-                for key, value in calculated_values.items():
-                    if 'NetCashProvidedByUsedInInvestingActivities' in key:
-                        randomized_content = randomized_content.replace(match, f"{abs(value):,}", 1)
-                        break
-                else:
-                    # Fallback if no investing total found
-                    randomized_content = randomized_content.replace(match, "25,000", 1)
-            else:
-                # Generate a reasonable financial value instead of 0
-                reasonable_value = random.randint(5000, 50000)
-                randomized_content = randomized_content.replace(match, f"{reasonable_value:,}", 1)
-        
-        # Write HTML file
-        html_output_file = f'html_out/{i}.html'
-        with open(html_output_file, 'w', encoding='utf-8') as f:
-            f.write(randomized_content)
-        generated_files['html'].append(html_output_file)
-        
-        # Generate JSON file
-        json_output_file = f'json_out/{i}.json'
-        try:
-            financial_data = extract_financial_data_from_html(html_output_file)
-            with open(json_output_file, 'w', encoding='utf-8') as f:
-                json.dump(financial_data, f, indent=2, ensure_ascii=False)
-            generated_files['json'].append(json_output_file)
-        except Exception as e:
-            print(f"Error generating {json_output_file}: {e}")
-        
-        print(f"Generated {html_output_file} and {json_output_file}")
+    # Numeric facts by tag, pointing at their template slot when scrambled
+    values_by_tag = {}
+    for fact in facts:
+        if fact['name'] and DIGITS_PATTERN.fullmatch(fact['text']):
+            source = fact['slot'] if fact['slot'] is not None else fact['text']
+            values_by_tag.setdefault(fact['name'], []).append(source)
+
+    original_strings = [original_value for original_value, _ in value_map.values()]
+    return {
+        'segments': segments,
+        'slot_plan': slot_plan,
+        'placeholders': placeholders,
+        'original_values': parse_original_values(original_strings),
+        'with_commas': [',' in original_value for original_value in original_strings],
+        'dependent_model': dependent_model,
+        'json_plan': plan_financial_data(values_by_tag),
+        'fact_table': fact_table,
+        # Minimized template the PDFs are rendered from
+        'pdf_template': minimize_template(segments),
+        # Original text and ix:nonfraction id behind each slot (slots follow document order)
+        'slot_texts': [fact['text'] for fact, _, _ in scrambled_facts],
+        'slot_ids': [fact['id'] for fact, _, _ in scrambled_facts],
+        # Relative references resolve against the input file's directory
+        'base_url': os.path.dirname(os.path.abspath(input_file))
+    }
+
+
+# Compiled templates are cached here, keyed by input content hash and scrambler version
+TEMPLATE_CACHE_DIR = '.template_cache'
+
+_scrambler_version = None
+
+
+def scrambler_version():
+    """Hash of this module's source, so any code change invalidates cached templates"""
+    global _scrambler_version
+    if _scrambler_version is None:
+        with open(__file__, 'rb') as f:
+            _scrambler_version = hashlib.sha256(f.read()).hexdigest()
+    return _scrambler_version
+
+
+def input_file_hash(input_file):
+    """SHA-256 of an input file's bytes, identifying its content wherever it is stored"""
+    try:
+        with open(input_file, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Input file '{input_file}' not found")
+
+
+def load_compiled_document(input_file='aapl_p33.html', cache_dir=TEMPLATE_CACHE_DIR):
+    """
+    Return compile_document(input_file), loading it from the template cache when possible.
+
+    The cache entry is keyed by the SHA-256 of the input file's bytes and the
+    scrambler version, so an edited input or a new scrambler compiles afresh.
+    Unreadable entries (truncated, or pickled under another numpy) are recompiled
+    and overwritten, and writing an entry removes the input's entries from other
+    scrambler versions.
+
+    Args:
+        input_file (str): Path to the input HTML file (default: 'aapl_p33.html')
+        cache_dir (str): Cache directory, or None to always compile (default: TEMPLATE_CACHE_DIR)
+
+    Returns:
+        dict: Result of compile_document
+    """
+    if cache_dir is None:
+        return compile_document(input_file)
+
+    input_hash = input_file_hash(input_file)
+    cache_file = os.path.join(cache_dir, f"{input_hash}-{scrambler_version()[:16]}.pickle")
+    try:
+        with open(cache_file, 'rb') as f:
+            compiled = pickle.load(f)
+        # The same content may be cached from another location
+        compiled['base_url'] = os.path.dirname(os.path.abspath(input_file))
+        return compiled
+    except Exception:
+        # Missing, truncated, or referring to modules this environment lacks
+        pass
+
+    compiled = compile_document(input_file)
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_file = f"{cache_file}.{os.getpid()}.tmp"
+    try:
+        with open(temp_file, 'wb') as f:
+            pickle.dump(compiled, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # Concurrent runs may race to write the same entry; the rename keeps it whole
+        os.replace(temp_file, cache_file)
+    finally:
+        # Only left behind when the dump or the rename failed
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    for stale_file in Path(cache_dir).glob(f"{input_hash}-*.pickle"):
+        if stale_file.name != os.path.basename(cache_file):
+            try:
+                stale_file.unlink()
+            except OSError:
+                pass
+    return compiled
+
+
+def print_stylesheet_diagnostics(input_file='aapl_p33.html', template_cache=TEMPLATE_CACHE_DIR):
+    """Print the selector diagnostics of the PDF stylesheet against an input file's PDF template"""
+    compiled = load_compiled_document(input_file, template_cache)
+    report = stylesheet_diagnostics(render_pdf_html(compiled, compiled['slot_texts']))
+    print(f"{'Selector':<64}{'Matches':>9}{'ms/render':>11}  Issue")
+    for entry in report:
+        matches = '-' if entry['matches'] is None else entry['matches']
+        ms = '-' if entry['ms'] is None else f"{entry['ms']:.2f}"
+        print(f"{entry['selector'][:63]:<64}{matches:>9}{ms:>11}  {entry['issue'] or ''}")
+    timed = [entry['ms'] for entry in report if entry['ms'] is not None]
+    flagged = [entry['ms'] for entry in report if entry['ms'] is not None and entry['issue']]
+    print(f"\nSelector matching: {sum(timed):.2f} ms per render, {sum(flagged):.2f} ms in flagged selectors")
+
+
+def render_slot(slot, randomized_independent_values, calculated_values, rng):
+    """Render the string for a single template slot of one variant"""
+    kind, key = slot
+    if kind == 'independent':
+        return randomized_independent_values[key]
+    if kind == 'calculated':
+        # Format with commas and handle negative values
+        return f"{abs(calculated_values[key]):,}"
+    if kind == 'investing':
+        # Use one of the calculated investing totals
+        if key is not None:
+            return f"{abs(calculated_values[key]):,}"
+        # Fallback if no investing total found
+        return "25,000"
+    # Generate a reasonable financial value instead of 0
+    return f"{int(rng.integers(5000, 50000, endpoint=True)):,}"
+
+
+def render_pdf_bytes(html_content, base_url):
+    """Render one HTML document to PDF bytes with this process's parsed stylesheet"""
+    return load_html(html_content, base_url).write_pdf(stylesheets=[_worker_stylesheet])
+
+
+def _text_alignment(line):
+    # Where a line's content is anchored: 'start', 'end' or 'center' (justify counts as start)
+    align = line.style['text_align_last']
+    if align == 'auto':
+        align = line.style['text_align_all']
+    if align in ('left', 'right'):
+        align = 'start' if (align == 'left') ^ (line.style['direction'] == 'rtl') else 'end'
+    return align if align in ('end', 'center') else 'start'
+
+
+def _locate_slot_boxes(box, ids, found, path=()):
+    # Collect (text box, its line, the inline boxes between them, the cell holding
+    # the line) for every slot id; outside tables the line's block stands for the cell
+    from weasyprint.formatting_structure import boxes
+    if isinstance(box, boxes.TextBox):
+        element_id = box.element.get('id') if box.element is not None else None
+        if element_id in ids:
+            if element_id in found:
+                raise ValueError(f"Fact {element_id} is laid out as more than one text box")
+            line_index = max(i for i, ancestor in enumerate(path) if isinstance(ancestor, boxes.LineBox))
+            cell = next((ancestor for ancestor in reversed(path[:line_index])
+                         if isinstance(ancestor, boxes.TableCellBox)), path[line_index - 1])
+            found[element_id] = (box, path[line_index], path[line_index + 1:], cell)
+        return
+    for child in getattr(box, 'children', ()):
+        _locate_slot_boxes(child, ids, found, path + (box,))
+
+
+def check_layout_support(document):
+    """
+    Check that a laid-out document exposes the WeasyPrint internals layout mode patches.
+
+    Layout mode relies on private attributes (page._page_box, TextBox.pango_layout,
+    line_break.line_size) that WeasyPrint may change in any release.
+
+    Raises:
+        RuntimeError: Naming the installed WeasyPrint version and what is missing
+    """
+    import weasyprint
+    from weasyprint.formatting_structure import boxes
+    from weasyprint.text import line_break
+
+    missing = []
+    if not hasattr(line_break, 'line_size'):
+        missing.append('weasyprint.text.line_break.line_size')
+    pages = [page for page in document.pages if hasattr(page, '_page_box')]
+    if len(pages) != len(document.pages):
+        missing.append('Page._page_box')
+    text_box = next((box for page in pages for box in page._page_box.descendants()
+                     if isinstance(box, boxes.TextBox)), None)
+    if text_box is not None:
+        layout = getattr(text_box, 'pango_layout', None)
+        if layout is None:
+            missing.append('TextBox.pango_layout')
+        elif not all(hasattr(layout, name) for name in ('reactivate', 'deactivate', 'get_first_line')):
+            missing.append('Layout.reactivate/deactivate/get_first_line')
+    if missing:
+        raise RuntimeError(f"--pdf-mode layout is not supported by WeasyPrint {weasyprint.__version__} "
+                           f"(missing {', '.join(missing)}); use --pdf-mode full")
+
+
+def _line_extent(line):
+    # Horizontal [left, right] of everything on a line
+    return (min(child.position_x for child in line.children),
+            max(child.position_x + child.margin_width() for child in line.children))
+
+
+def build_layout_template(compiled):
+    """
+    Lay out a compiled document once and locate the text box of every slot.
+
+    The minimized PDF template is rendered with its original values. For each of
+    its slots the text box of the ix:nonfraction is recorded with its line, its alignment anchor,
+    the boxes it shares the line with and the horizontal bounds the line must stay
+    within (its cell's content box, or wider if the original already overflowed),
+    so a variant's digits can later be written straight into this fixed layout by
+    patch_layout_template.
+
+    Args:
+        compiled (dict): Result of compile_document
+
+    Returns:
+        dict: document (the laid-out WeasyPrint document) and slots (one
+              (template slot, text box, line, shift plan) entry per rendered slot)
+
+    Raises:
+        ValueError: If a slot's fact has no id or does not map to exactly one text box
+        RuntimeError: If this WeasyPrint version lacks the layout internals patched here
+    """
+    slot_ids = {slot: compiled['slot_ids'][slot] for slot in compiled['pdf_template']['slots']}
+    missing = [slot for slot, element_id in slot_ids.items() if not element_id]
+    if missing:
+        raise ValueError(f"Layout template needs an id on every scrambled fact; slots {missing[:5]} have none")
+
+    html_content = render_pdf_html(compiled, compiled['slot_texts'])
+    document = load_html(html_content, compiled['base_url']).render(stylesheets=[_worker_stylesheet])
+
+    check_layout_support(document)
+
+    found = {}
+    ids = set(slot_ids.values())
+    for page in document.pages:
+        _locate_slot_boxes(page._page_box, ids, found)
+
+    slots = []
+    for slot, element_id in slot_ids.items():
+        if element_id not in found:
+            raise ValueError(f"Fact {element_id} (slot {slot}) was not laid out as text")
+        text_box, line, ancestors, cell = found[element_id]
+
+        # Boxes before and after the slot's text at every level of the line
+        chain = (line,) + ancestors + (text_box,)
+        before, after = [], []
+        for parent, child in zip(chain, chain[1:]):
+            position = next(i for i, sibling in enumerate(parent.children) if sibling is child)
+            before.extend(parent.children[:position])
+            after.extend(parent.children[position + 1:])
+        slots.append({
+            'slot': slot,
+            'box': text_box,
+            'line': line,
+            'ancestors': ancestors,
+            'before': before,
+            'after': after,
+            'align': _text_alignment(line),
+            'bounds': (min(cell.content_box_x(), _line_extent(line)[0]),
+                       max(cell.content_box_x() + cell.width, _line_extent(line)[1])),
+        })
+    return {'document': document, 'slots': slots}
+
+
+def _set_box_text(text_box, text):
+    # Replace a laid-out text box's text and return the change in its width
+    from weasyprint.text.line_break import line_size
+    layout = text_box.pango_layout
+    layout.text = text
+    layout.reactivate(text_box.style)
+    first_line, _ = layout.get_first_line()
+    width, _ = line_size(first_line, text_box.style)
+    layout.deactivate()
+    text_box.text = text
+    delta = width - text_box.width
+    text_box.width = width
+    return delta
+
+
+def patch_layout_template(layout_template, slot_values, tolerance=0.01):
+    """
+    Patch one variant's slot values into the fixed layout.
+
+    Each slot's text box takes its new string and keeps its alignment anchor:
+    in a right-aligned cell the box grows to the left and the boxes before it
+    on the line move with it. Nothing is re-parsed, re-styled or re-laid out,
+    so table geometry is that of the original document. A wider value may then
+    no longer fit its cell and would overlap its neighbours; such slots are
+    returned, and the patched layout must not be written for this variant.
+
+    Args:
+        layout_template (dict): Result of build_layout_template
+        slot_values (list): One rendered string per template slot
+        tolerance (float): Overflow ignored, in CSS px (default: 0.01)
+
+    Returns:
+        list: Template slots whose line no longer fits its cell
+    """
+    for slot in layout_template['slots']:
+        value = slot_values[slot['slot']]
+        text_box = slot['box']
+        if value == text_box.text:
+            continue
+        delta = _set_box_text(text_box, value)
+        if not delta:
+            continue
+
+        # Share of the growth taken on the left of the box
+        left = {'start': 0, 'center': delta / 2, 'end': delta}[slot['align']]
+        text_box.position_x -= left
+        for box in slot['before']:
+            box.translate(-left)
+        for box in slot['after']:
+            box.translate(delta - left)
+        for box in slot['ancestors']:
+            box.position_x -= left
+            box.width += delta
+        slot['line'].width += delta
+
+    # Checked once every line is patched, and also for values left unchanged
+    # from an earlier variant that already overflowed
+    overflow = []
+    for slot in layout_template['slots']:
+        line_left, line_right = _line_extent(slot['line'])
+        cell_left, cell_right = slot['bounds']
+        if line_left < cell_left - tolerance or line_right > cell_right + tolerance:
+            overflow.append(slot['slot'])
+    return overflow
+
+
+def write_layout_pdf(layout_template, slot_values, target=None):
+    """
+    Write one variant's PDF by patching its slot values into the fixed layout.
+
+    Args:
+        layout_template (dict): Result of build_layout_template
+        slot_values (list): One rendered string per template slot
+        target: File name or file object, or None to return the PDF bytes
+
+    Returns:
+        bytes or None: PDF bytes when target is None
+
+    Raises:
+        ValueError: If a patched value no longer fits its cell
+    """
+    overflow = patch_layout_template(layout_template, slot_values)
+    if overflow:
+        raise ValueError(f"Values of slots {overflow[:5]} no longer fit their cells")
+    return layout_template['document'].write_pdf(target)
+
+
+def layout_text_positions(document):
+    """(text, x, y) of every text box of a laid-out document, in drawing order"""
+    from weasyprint.formatting_structure import boxes
+    return [(box.text, box.position_x, box.position_y)
+            for page in document.pages for box in page._page_box.descendants()
+            if isinstance(box, boxes.TextBox)]
+
+
+def verify_layout_pdf(layout_template, html_content, base_url, tolerance=0.01):
+    """
+    Compare the patched layout against a full WeasyPrint layout of the same variant.
+
+    Returns:
+        dict: ok, text_mismatches (boxes whose text differs), max_offset (largest
+              position difference in CSS px), box_counts (patched, full) and
+              document (the full layout)
+    """
+    full = load_html(html_content, base_url).render(stylesheets=[_worker_stylesheet])
+    patched_boxes = layout_text_positions(layout_template['document'])
+    full_boxes = layout_text_positions(full)
+
+    text_mismatches = sum(1 for a, b in zip(patched_boxes, full_boxes) if a[0] != b[0])
+    max_offset = max((max(abs(a[1] - b[1]), abs(a[2] - b[2])) for a, b in zip(patched_boxes, full_boxes)),
+                     default=0.0)
+    return {
+        'ok': len(patched_boxes) == len(full_boxes) and not text_mismatches and max_offset <= tolerance,
+        'text_mismatches': text_mismatches,
+        'max_offset': max_offset,
+        'box_counts': (len(patched_boxes), len(full_boxes)),
+        'document': full,
+    }
+
+
+def layout_check_due(index, first_index, variant_count, verify_layout):
+    """
+    Whether variant index is one of verify_layout layout checks spread evenly over
+    the variant_count variants from first_index, so late variants are sampled too.
+    """
+    if verify_layout <= 0:
+        return False
+    step = max(1, variant_count // verify_layout)
+    offset = index - first_index
+    return offset % step == 0 and offset // step < verify_layout
+
+
+def render_layout_pdf(layout_template, slot_values, pdf_file, html_content, base_url, verify=False):
+    """
+    Write one variant's PDF from the layout template, optionally verifying it.
+
+    When a patched value no longer fits its cell the variant is laid out in full
+    from html_content instead.
+
+    Args:
+        layout_template (dict): Result of build_layout_template
+        slot_values (list): One rendered string per template slot
+        pdf_file (str): Output path
+        html_content (str): The variant's minimized PDF HTML
+        base_url (str): Base URL for a full render
+        verify (bool): Compare the patched layout against a full WeasyPrint layout,
+            and on a mismatch rewrite the PDF from that full layout (default: False)
+
+    Returns:
+        list: Progress messages to print
+    """
+    try:
+        overflow = patch_layout_template(layout_template, slot_values)
+        if overflow:
+            with open(pdf_file, 'wb') as f:
+                f.write(render_pdf_bytes(html_content, base_url))
+            return [f"Generated {pdf_file}",
+                    f"Layout {pdf_file}: slots {overflow[:5]} overflow their cells, rendered in full"]
+        layout_template['document'].write_pdf(pdf_file)
+    except Exception as e:
+        return [f"Error generating {pdf_file}: {e}"]
+    messages = [f"Generated {pdf_file}"]
+    if verify:
+        check = verify_layout_pdf(layout_template, html_content, base_url)
+        if check['ok']:
+            messages.append(f"Layout check {pdf_file}: ok")
+        else:
+            messages.append(f"Layout check {pdf_file}: MISMATCH ({check['text_mismatches']} text, "
+                            f"max offset {check['max_offset']:.2f}px, boxes {check['box_counts']}), "
+                            f"rewritten from the full render")
+            check['document'].write_pdf(pdf_file)
+    return messages
+
+
+def iter_variant_values(compiled, count=None, start=1, seed=None, batch_size=1000):
+    """
+    Lazily sample and calculate the values of each variant of a compiled document.
+
+    Independent values are sampled, and dependent values calculated, one batch
+    at a time, so memory stays constant however many variants are consumed.
+    With a seed, every variant draws from its own random stream derived from
+    (seed, index), so any variant can be regenerated alone and a split run
+    produces exactly the same output as a serial one.
+
+    Args:
+        compiled (dict): Result of compile_document
+        count (int): Number of variants, or None to generate indefinitely
+        start (int): Index of the first variant (default: 1)
+        seed (int): Seed for reproducible output (default: None, unseeded)
+        batch_size (int): Variants sampled per vectorized draw (default: 1000)
+
+    Yields:
+        tuple: (index, slot_values, sampled_row, calculated_values), with one
+               rendered string per template slot
+    """
+    placeholders = compiled['placeholders']
+    dependent_keys = compiled['dependent_model']['keys']
+    index = start
+    end = None if count is None else start + count
+    while end is None or index < end:
+        batch_indexes = range(index, index + batch_size if end is None else min(index + batch_size, end))
+        if seed is None:
+            # One generator draws the whole batch in a single call
+            rng = np.random.default_rng()
+            rngs = [rng] * len(batch_indexes)
+            sampled_values = sample_independent_values(compiled['original_values'], len(batch_indexes), rng=rng)
+        else:
+            rngs = [variant_rng(seed, i) for i in batch_indexes]
+            sampled_values = np.vstack([sample_independent_values(compiled['original_values'], 1, rng=variant)
+                                        for variant in rngs])
+        # Calculate dependent values for every variant and year with one matrix product
+        calculated_matrix = evaluate_dependent_model(compiled['dependent_model'], sampled_values)
+
+        for i, rng, sampled_row, calculated_row in zip(batch_indexes, rngs, sampled_values.tolist(),
+                                                        calculated_matrix.tolist()):
+            randomized_independent_values = {
+                placeholder: format_sampled_value(value, commas)
+                for placeholder, value, commas in zip(placeholders, sampled_row, compiled['with_commas'])
+            }
+            calculated_values = dict(zip(dependent_keys, calculated_row))
 
-    # Generate PDF files from HTML files with comprehensive styling
-    css = CSS(string='''
-    @page {
-        size: letter;
-        margin: 0.75in 1in;
-        @top-center {
-            content: "Apple Inc. - Financial Statement";
-            font-family: Helvetica, sans-serif;
-            font-size: 10pt;
-            font-weight: bold;
-        }
-        @bottom-center {
-            content: "Page " counter(page) " of " counter(pages);
-            font-family: Helvetica, sans-serif;
-            font-size: 9pt;
+            # Fill every slot in document order
+            slot_values = [render_slot(slot, randomized_independent_values, calculated_values, rng)
+                           for slot in compiled['slot_plan']]
+            yield i, slot_values, sampled_row, calculated_values
+        index = batch_indexes.stop
+
+
+def iter_variants(compiled, count=None, start=1, seed=None, include_pdf=False, batch_size=1000):
+    """
+    Lazily generate variants of a compiled document.
+
+    Args:
+        compiled (dict): Result of compile_document
+        count (int): Number of variants, or None to generate indefinitely
+        start (int): Index of the first variant (default: 1)
+        seed (int): Seed for reproducible output (default: None, unseeded)
+        include_pdf (bool): Also render each variant to PDF bytes (default: False)
+        batch_size (int): Variants sampled per vectorized draw (default: 1000)
+
+    Yields:
+        dict: index, html, json rows, independent_values and calculated_values
+              as ints, slot_values (one string per template slot) and pdf bytes (or None)
+    """
+    placeholders = compiled['placeholders']
+    for i, slot_values, sampled_row, calculated_values in iter_variant_values(
+            compiled, count=count, start=start, seed=seed, batch_size=batch_size):
+        html_content = render_template(compiled['segments'], slot_values)
+
+        yield {
+            'index': i,
+            'html': html_content,
+            'json': build_financial_data(compiled['json_plan'], slot_values),
+            'independent_values': dict(zip(placeholders, sampled_row)),
+            'calculated_values': calculated_values,
+            'slot_values': slot_values,
+            'pdf': render_pdf_bytes(render_pdf_html(compiled, slot_values), compiled['base_url']) if include_pdf else None
         }
-    }
 
-    /* Base styling */
-    body {
-        font-family: Helvetica, Arial, sans-serif;
-        font-size: 8.5pt;
-        line-height: 1.2;
-        color: #000000;
-        margin: 0;
-        padding: 0;
-    }
 
-    /* Hide XBRL metadata */
-    div[style*="display:none"], 
-    ix\\:header, 
-    ix\\:header * {
-        display: none !important;
-    }
+def generate_variant(compiled, index, seed, include_pdf=False):
+    """Regenerate variant `index` of a seeded run without generating the ones before it"""
+    return next(iter_variants(compiled, count=1, start=index, seed=seed, include_pdf=include_pdf))
 
-    /* Main content styling */
-    div {
-        page-break-inside: avoid;
-    }
 
-    /* Table styling for financial statements */
-    table {
-        width: 100%;
-        border-collapse: collapse;
-        margin-bottom: 12pt;
-        page-break-inside: avoid;
-        font-size: 8.5pt;
-    }
+def iter_scrambled_variants(input_file='aapl_p33.html', count=None, seed=None, include_pdf=False, batch_size=1000,
+                            template_cache=None):
+    """
+    Stream scrambled variants of an XBRL HTML file one at a time.
 
-    /* Table cells */
-    td {
-        padding: 2px 4px;
-        vertical-align: top;
-        border: none;
-    }
+    The input is parsed once and each variant is built only when the caller asks
+    for it. Nothing is written to disk unless a template_cache directory is given.
 
-    /* Header rows with borders */
-    td[style*="border-top"] {
-        border-top: 1pt solid #000000;
-    }
+    Args:
+        input_file (str): Path to the input HTML file (default: 'aapl_p33.html')
+        count (int): Number of variants, or None to generate indefinitely
+        seed (int): Seed for reproducible output (default: None, unseeded)
+        include_pdf (bool): Also render each variant to PDF bytes (default: False)
+        batch_size (int): Variants sampled per vectorized draw (default: 1000)
+        template_cache (str): Compiled-template cache directory, or None to always
+            compile (default: None)
 
-    /* Alternating row backgrounds */
-    tr:has(td[style*="background-color:#efefef"]) {
-        background-color: #efefef;
-    }
+    Yields:
+        dict: See iter_variants
+    """
+    compiled = load_compiled_document(input_file, template_cache)
+    yield from iter_variants(compiled, count=count, seed=seed, include_pdf=include_pdf, batch_size=batch_size)
 
-    tr:has(td[style*="background-color:#ffffff"]) {
-        background-color: #ffffff;
-    }
 
-    /* Text alignment */
-    .text-center, 
-    td[style*="text-align:center"] {
-        text-align: center;
-    }
+def render_template_bytes(segments, slot_values):
+    """Interleave memory-mapped template segments with one rendered string per slot, as UTF-8"""
+    parts = [None] * (len(segments) + len(slot_values))
+    parts[0::2] = segments
+    parts[1::2] = [value.encode('utf-8') for value in slot_values]
+    return b''.join(parts)
 
-    .text-right, 
-    td[style*="text-align:right"] {
-        text-align: right;
-    }
 
-    .text-left, 
-    td[style*="text-align:left"] {
-        text-align: left;
-    }
+def write_template_file(compiled, template_file):
+    """
+    Lay out the bulky parts of a compiled document in one flat file for memory-mapping.
 
-    /* Typography */
-    span[style*="font-weight:700"] {
-        font-weight: bold;
-    }
+    The file holds the UTF-8 template segments and then the minimized PDF template
+    segments back to back, followed by the segment boundaries, the original values and the dependent-model arrays.
 
-    span[style*="font-size:9pt"] {
-        font-size: 9pt;
-    }
+    Args:
+        compiled (dict): Result of compile_document
+        template_file (str): Path of the file to write
 
-    span[style*="font-size:8pt"] {
-        font-size: 8pt;
+    Returns:
+        dict: name -> (byte offset, dtype string, shape) of every array in the file
+    """
+    encoded = [segment.encode('utf-8') for segment in compiled['segments'] + compiled['pdf_template']['segments']]
+    model = compiled['dependent_model']
+    arrays = {
+        'segment_bounds': np.cumsum([0] + [len(segment) for segment in encoded], dtype=np.int64),
+        'original_values': compiled['original_values'],
+        'coefficients': model['coefficients'],
+        'intercepts': model['intercepts'],
+        'minimums': model['minimums'],
     }
+    layout = {}
+    with open(template_file, 'wb') as f:
+        offset = f.write(b''.join(encoded))
+        for name, array in arrays.items():
+            # Keep every array 8-byte aligned
+            offset += f.write(b'\0' * (-offset % 8))
+            array = np.ascontiguousarray(array)
+            layout[name] = (offset, array.dtype.str, array.shape)
+            offset += f.write(array.tobytes())
+    return layout
 
-    span[style*="font-size:8.5pt"] {
-        font-size: 8.5pt;
-    }
 
-    /* Title styling */
-    div:has(span[style*="font-weight:700"][style*="font-size:9pt"]) {
-        text-align: center;
-        margin: 12pt 0;
-        font-weight: bold;
+def template_metadata(compiled):
+    """The small parts of a compiled document that workers receive once, at start-up"""
+    return {
+        'slot_plan': compiled['slot_plan'],
+        'placeholders': compiled['placeholders'],
+        'with_commas': compiled['with_commas'],
+        'json_plan': compiled['json_plan'],
+        'dependent_keys': compiled['dependent_model']['keys'],
+        'segment_count': len(compiled['segments']),
+        'pdf_slots': compiled['pdf_template']['slots'],
+        'slot_texts': compiled['slot_texts'],
+        'slot_ids': compiled['slot_ids'],
+        'base_url': compiled['base_url'],
     }
 
-    /* Ensure numbers align properly */
-    span:contains("$"), 
-    span:contains("(") {
-        font-family: "Courier New", monospace;
-    }
 
-    /* Page break controls */
-    .page-break-before {
-        page-break-before: always;
-    }
+# Compiled document attached by each variant worker, and its layout template once built
+_worker_template = None
+_worker_layout = None
 
-    .page-break-after {
-        page-break-after: always;
-    }
 
-    .no-page-break {
-        page-break-inside: avoid;
-    }
+def init_variant_worker(template_file, layout, metadata):
+    """
+    Attach this process to the memory-mapped template written by write_template_file.
 
-    /* Financial statement specific styling */
-    div[style*="min-height:42.75pt"] {
-        min-height: 42.75pt;
-        page-break-after: avoid;
-    }
+    Segments and arrays are views on the shared mapping, so every worker reads
+    the same pages instead of holding its own copy of the document.
+    """
+    global _worker_template
+    with open(template_file, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-    /* Indentation levels for financial line items */
-    div[style*="padding-left:9pt"] {
-        padding-left: 9pt;
-    }
+    def mapped_array(name):
+        offset, dtype, shape = layout[name]
+        return np.frombuffer(mapped, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
 
-    div[style*="padding-left:15.75pt"] {
-        padding-left: 15.75pt;
+    view = memoryview(mapped)
+    bounds = mapped_array('segment_bounds').tolist()
+    segments = [view[a:b] for a, b in zip(bounds, bounds[1:])]
+    segment_count = metadata['segment_count']
+    _worker_template = {
+        'segments': segments[:segment_count],
+        'pdf_template': {'segments': segments[segment_count:], 'slots': metadata['pdf_slots']},
+        'slot_plan': metadata['slot_plan'],
+        'placeholders': metadata['placeholders'],
+        'original_values': mapped_array('original_values'),
+        'with_commas': metadata['with_commas'],
+        'dependent_model': {
+            'keys': metadata['dependent_keys'],
+            'coefficients': mapped_array('coefficients'),
+            'intercepts': mapped_array('intercepts'),
+            'minimums': mapped_array('minimums'),
+        },
+        'json_plan': metadata['json_plan'],
+        'slot_texts': metadata['slot_texts'],
+        'slot_ids': metadata['slot_ids'],
+        'base_url': metadata['base_url'],
     }
 
-    div[style*="padding-left:27pt"] {
-        padding-left: 27pt;
-    }
 
-    div[style*="padding-left:30.25pt"] {
-        padding-left: 30.25pt;
-    }
+def generate_variant_chunk(task):
+    """
+    Generate and write one range of variants.
 
-    /* Print-specific optimizations */
-    @media print {
-        body {
-            -webkit-print-color-adjust: exact;
-            print-color-adjust: exact;
-        }
-        
-        table {
-            font-size: 8pt;
-        }
-        
-        /* Ensure financial tables don't break across pages */
-        table[style*="border-collapse:collapse"] {
-            page-break-inside: avoid;
-        }
-    }
-    ''')
+    The task is (start, count, seed, output_dir, write_html, write_pdf, pdf_mode,
+    verify, minimize_pdf), where verify is the (first_index, variant_count,
+    verify_layout) of the whole run passed to layout_check_due.
+
+    Returns:
+        dict: html, json and pdf files written, the progress messages to print and
+              the asset fetch counts of the PDF renders
+    """
+    global _worker_layout
+    start, count, seed, output_dir, write_html, write_pdf, pdf_mode, verify, minimize_pdf = task
+    compiled = _worker_template
+    written = {'html': [], 'json': [], 'pdf': [], 'messages': [], 'fetches': Counter()}
+    for i, slot_values, _, _ in iter_variant_values(compiled, count=count, start=start, seed=seed):
+        html_bytes = render_template_bytes(compiled['segments'], slot_values)
+
+        if write_html:
+            html_output_file = os.path.join(output_dir or '', 'html_out', f'{i}.html')
+            with open(html_output_file, 'wb') as f:
+                f.write(html_bytes)
+            written['html'].append(html_output_file)
 
-    for i in range(1, generate_file_count + 1):
-        html_file = f'html_out/{i}.html'
-        pdf_file = f'pdf_out/{i}.pdf'
+        json_output_file = os.path.join(output_dir or '', 'json_out', f'{i}.json')
         try:
-            HTML(html_file).write_pdf(pdf_file, stylesheets=[css])
-            generated_files['pdf'].append(pdf_file)
-            print(f"Generated {pdf_file}")
+            with open(json_output_file, 'w', encoding='utf-8') as f:
+                json.dump(build_financial_data(compiled['json_plan'], slot_values), f, indent=2, ensure_ascii=False)
+            written['json'].append(json_output_file)
         except Exception as e:
-            print(f"Error generating {pdf_file}: {e}")
+            written['messages'].append(f"Error generating {json_output_file}: {e}")
+
+        if write_html:
+            written['messages'].append(f"Generated {html_output_file} and {json_output_file}")
+        else:
+            written['messages'].append(f"Generated {json_output_file}")
+
+        pdf_file = os.path.join(output_dir or '', 'pdf_out', f'{i}.pdf')
+        if write_pdf and pdf_mode == 'layout':
+            if _worker_layout is None:
+                _worker_layout = build_layout_template(compiled)
+            messages = render_layout_pdf(_worker_layout, slot_values, pdf_file,
+                                         render_pdf_html(compiled, slot_values), compiled['base_url'],
+                                         verify=layout_check_due(i, *verify))
+            if messages[0].startswith('Generated'):
+                written['pdf'].append(pdf_file)
+            written['messages'].extend(messages)
+        elif write_pdf:
+            pdf_html = render_pdf_html(compiled, slot_values) if minimize_pdf else html_bytes.decode('utf-8')
+            pdf_file, error, counts = render_pdf_job((pdf_html, pdf_file, compiled['base_url']))
+            written['fetches'].update(counts)
+            if error is None:
+                written['pdf'].append(pdf_file)
+                written['messages'].append(f"Generated {pdf_file}")
+            else:
+                written['messages'].append(f"Error generating {pdf_file}: {error}")
+    written['fetches'].update(take_fetch_counts())
+    return written
+
+
+def generate_variants_parallel(compiled, first_index, variant_count, seed, output_dir, write_html, write_pdf,
+                               workers, chunk_size=None, pdf_mode='full', verify_layout=0, minimize_pdf=True):
+    """
+    Generate variants across worker processes sharing one memory-mapped template.
+
+    The template is written to a temporary file once; each worker maps it at
+    start-up, and tasks carry only an index range, so nothing large is pickled
+    per task. Seeded output is identical to a serial run.
+
+    Args:
+        compiled (dict): Result of compile_document
+        first_index (int): Index of the first variant
+        variant_count (int): Number of variants
+        seed (int): Seed for reproducible output, or None
+        output_dir (str): Directory holding html_out/json_out/pdf_out, or None
+        write_html (bool): Write html_out files
+        write_pdf (bool): Render pdf_out files in the same workers
+        workers (int): Number of worker processes
+        chunk_size (int): Variants per task (default: about four tasks per worker)
+        pdf_mode (str): 'full' renders every PDF; 'layout' patches a per-worker layout
+            template (default: 'full')
+        verify_layout (int): Number of variants, spread evenly over the run, whose
+            layout PDF is checked against a full render (default: 0)
+        minimize_pdf (bool): Render full-mode PDFs from the minimized template (default: True)
+
+    Returns:
+        dict: html, json and pdf files written, in variant order
+    """
+    if chunk_size is None:
+        chunk_size = max(1, min(1000, -(-variant_count // (workers * 4))))
+    tasks = [(start, min(chunk_size, first_index + variant_count - start), seed, output_dir, write_html, write_pdf,
+              pdf_mode, (first_index, variant_count, verify_layout), minimize_pdf)
+             for start in range(first_index, first_index + variant_count, chunk_size)]
+
+    fd, template_file = tempfile.mkstemp(suffix='.template')
+    os.close(fd)
+    generated_files = {'html': [], 'json': [], 'pdf': []}
+    fetch_counts = Counter()
+    try:
+        layout = write_template_file(compiled, template_file)
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_variant_worker,
+                                 initargs=(template_file, layout, template_metadata(compiled))) as pool:
+            for written in pool.map(generate_variant_chunk, tasks):
+                for message in written['messages']:
+                    print(message)
+                for kind in generated_files:
+                    generated_files[kind].extend(written[kind])
+                fetch_counts.update(written['fetches'])
+    finally:
+        os.remove(template_file)
+    if write_pdf:
+        print(f"PDF assets: {format_fetch_counts(fetch_counts)}")
+    return generated_files
+
+
+def shard_range(total, shard_index, shard_count):
+    """
+    Contiguous range of variant indices owned by one shard.
+
+    Args:
+        total (int): Number of variants in the whole corpus
+        shard_index (int): This shard, from 1 to shard_count
+        shard_count (int): Number of shards
+
+    Returns:
+        tuple: (first variant index, number of variants)
+    """
+    if not 1 <= shard_index <= shard_count:
+        raise ValueError(f"Shard {shard_index} out of range (1..{shard_count})")
+    base, extra = divmod(total, shard_count)
+    # The first `extra` shards take one variant more
+    count = base + (1 if shard_index <= extra else 0)
+    first = 1 + (shard_index - 1) * base + min(shard_index - 1, extra)
+    return first, count
+
+
+def shard_output_dir(shard_index, shard_count):
+    """Default output directory of a shard, so shards on shared storage never collide"""
+    return f'shard_{shard_index}_of_{shard_count}'
+
+
+def scramble_financial_data(generate_file_count=10, input_file='aapl_p33.html', pdf_workers=1, write_html=True,
+                            seed=None, shard=None, output_dir=None, write_pdf=True,
+                            template_cache=TEMPLATE_CACHE_DIR, generate_workers=1, pdf_mode='full',
+                            verify_layout=1, minimize_pdf=True):
+    """
+    Scramble financial data from an XBRL HTML file while maintaining accounting relationships.
+    
+    Args:
+        generate_file_count (int): Number of randomized files to generate (default: 10)
+        input_file (str): Path to the input HTML file (default: 'aapl_p33.html')
+        pdf_workers (int): Number of processes rendering PDFs in parallel (default: 1)
+        write_html (bool): Also save each variant to html_out (default: True)
+        seed (int): Seed for reproducible output; variant i depends only on (seed, i) (default: None)
+        shard (tuple): (shard_index, shard_count) to generate only this node's disjoint share
+            of the generate_file_count variants and write a shard manifest (default: None)
+        output_dir (str): Directory holding html_out/json_out/pdf_out (default: the current
+            directory, or shard_{i}_of_{n} when sharded)
+        write_pdf (bool): Render each variant to pdf_out; without it WeasyPrint is never
+            loaded (default: True)
+        template_cache (str): Compiled-template cache directory, or None to always
+            compile (default: TEMPLATE_CACHE_DIR)
+        generate_workers (int): Processes generating variants from a shared memory-mapped
+            template; above 1 they also render their own PDFs and pdf_workers is unused
+            (default: 1)
+        pdf_mode (str): 'full' lays out every variant with WeasyPrint; 'layout' lays out
+            the minimized statement once and patches each variant's numbers into it,
+            in this process or in each generate worker (default: 'full')
+        verify_layout (int): In 'layout' mode, check this many variants, spread evenly
+            over the run, against a full WeasyPrint render (default: 1)
+        minimize_pdf (bool): Render PDFs from the template with the hidden ix:header,
+            dead <link>/<style> blocks and comments cut out; html_out is unaffected
+            (default: True)
+    
+    Returns:
+        dict: Summary of generated files and statistics
+
+    Raises:
+        ValueError: If 'layout' mode is combined with pdf_workers > 1 or minimize_pdf=False
+    """
+    if pdf_mode == 'layout' and pdf_workers > 1:
+        raise ValueError("pdf_mode='layout' does not use pdf_workers; parallelize it with generate_workers")
+    if pdf_mode == 'layout' and not minimize_pdf:
+        raise ValueError("pdf_mode='layout' always patches the minimized template; it needs minimize_pdf=True")
+
+    if shard is not None:
+        first_index, variant_count = shard_range(generate_file_count, *shard)
+        if output_dir is None:
+            output_dir = shard_output_dir(*shard)
+    else:
+        first_index, variant_count = 1, generate_file_count
+
+    def output_path(*parts):
+        return os.path.join(output_dir, *parts) if output_dir else os.path.join(*parts)
+
+    # Main processing logic
+    print("Processing HTML content...")
+    compiled = load_compiled_document(input_file, template_cache)
+    fact_table = compiled['fact_table']
+
+    dependent_count = int(fact_table['dependent'].sum())
+    independent_count = len(fact_table['dependent']) - dependent_count
+
+    print(f"Found {independent_count} independent values to randomize")
+    print(f"Found {dependent_count} dependent values to calculate")
+
+    # Create output directories
+    os.makedirs(output_path('html_out'), exist_ok=True)
+    os.makedirs(output_path('json_out'), exist_ok=True)
+    if write_pdf:
+        os.makedirs(output_path('pdf_out'), exist_ok=True)
+
+    # Generate randomized versions with proper calculations
+    generated_files = {'html': [], 'json': [], 'pdf': []}
+
+    layout_template = None
+    if write_pdf and pdf_mode == 'layout' and generate_workers <= 1:
+        print("Laying out the PDF template...")
+        layout_template = build_layout_template(compiled)
+    
+    def generate_variants():
+        """Write each in-memory variant's HTML/JSON outputs and yield its PDF job"""
+        for variant in iter_variants(compiled, count=variant_count, start=first_index, seed=seed):
+            i = variant['index']
+            
+            # Write HTML file (optional - PDF and JSON are built from the in-memory variant)
+            if write_html:
+                html_output_file = output_path('html_out', f'{i}.html')
+                with open(html_output_file, 'w', encoding='utf-8') as f:
+                    f.write(variant['html'])
+                generated_files['html'].append(html_output_file)
+            
+            # Generate JSON file
+            json_output_file = output_path('json_out', f'{i}.json')
+            try:
+                with open(json_output_file, 'w', encoding='utf-8') as f:
+                    json.dump(variant['json'], f, indent=2, ensure_ascii=False)
+                generated_files['json'].append(json_output_file)
+            except Exception as e:
+                print(f"Error generating {json_output_file}: {e}")
+            
+            if write_html:
+                print(f"Generated {html_output_file} and {json_output_file}")
+            else:
+                print(f"Generated {json_output_file}")
+            
+            pdf_file = output_path('pdf_out', f'{i}.pdf')
+            if layout_template is not None:
+                messages = render_layout_pdf(layout_template, variant['slot_values'], pdf_file,
+                                             render_pdf_html(compiled, variant['slot_values']), compiled['base_url'],
+                                             verify=layout_check_due(i, first_index, variant_count, verify_layout))
+                if messages[0].startswith('Generated'):
+                    generated_files['pdf'].append(pdf_file)
+                for message in messages:
+                    print(message)
+                continue
+            
+            pdf_html = render_pdf_html(compiled, variant['slot_values']) if minimize_pdf else variant['html']
+            yield pdf_html, pdf_file, compiled['base_url']
+
+    if generate_workers > 1:
+        generated_files = generate_variants_parallel(compiled, first_index, variant_count, seed, output_dir,
+                                                     write_html, write_pdf, generate_workers,
+                                                     pdf_mode=pdf_mode, verify_layout=verify_layout,
+                                                     minimize_pdf=minimize_pdf)
+    # Generate PDF files straight from the in-memory variants with comprehensive styling
+    elif write_pdf and layout_template is None:
+        generated_files['pdf'].extend(render_pdfs(generate_variants(), workers=pdf_workers))
+    else:
+        for _ in generate_variants():
+            pass
+    if layout_template is not None:
+        print(f"PDF assets: {format_fetch_counts(take_fetch_counts())}")
 
     # Save detailed mapping to CSV file
-    mapping_file = 'html_out/cash_flow_mapping.csv'
+    mapping_file = output_path('html_out', 'cash_flow_mapping.csv')
     with open(mapping_file, 'w', newline='', encoding='utf-8') as csvfile:
         writer = csv.writer(csvfile)
         writer.writerow(['XBRL Tag', 'Original Value', 'Value Type', 'Placeholder'])
         
-        for key, data in extracted_values.items():
-            value_type = 'Dependent (Calculated)' if data['is_dependent'] else 'Independent (Randomized)'
-            writer.writerow([data['tag'], data['original_value'], value_type, data['placeholder']])
+        for tag_id, original_value, is_dependent, placeholder in zip(
+                fact_table['tag_ids'].tolist(), fact_table['texts'], fact_table['dependent'].tolist(),
+                fact_table['placeholders']):
+            value_type = 'Dependent (Calculated)' if is_dependent else 'Independent (Randomized)'
+            writer.writerow([fact_table['tags'][tag_id], original_value, value_type, placeholder])
+
+    manifest_file = None
+    if shard is not None:
+        manifest_file = write_shard_manifest(output_dir, {
+            'input_file': input_file,
+            'input_sha256': input_file_hash(input_file),
+            'seed': seed,
+            'shard': list(shard),
+            'total_variants': generate_file_count,
+            'first_index': first_index,
+            'variant_count': variant_count,
+            'mapping_file': mapping_file,
+            'generated_files': generated_files
+        })
 
     print(f"\nRandomization complete with proper accounting relationships!")
     print(f"Independent values randomized: {independent_count}")
     print(f"Dependent values calculated: {dependent_count}")
     print(f"\nDetailed mapping saved to: {mapping_file}")
+    if manifest_file:
+        print(f"Shard manifest saved to: {manifest_file}")
     print(f"\nThe following relationships are maintained:")
     print("• Operating Activities = Net Income + Adjustments + Working Capital Changes")  
     print("• Investing Activities = Sum of all investing line items")
@@ -863,15 +2462,170 @@ def scramble_financial_data(generate_file_count=10, input_file='aapl_p33.html'):
 
     # Return summary
     return {
-        'files_generated': generate_file_count,
+        'files_generated': variant_count,
         'independent_values': independent_count,
         'dependent_values': dependent_count,
         'generated_files': generated_files,
-        'mapping_file': mapping_file
+        'mapping_file': mapping_file,
+        'manifest_file': manifest_file
+    }
+
+
+def write_shard_manifest(output_dir, shard_info):
+    """
+    Write manifest.json describing one shard's outputs.
+
+    File paths are stored relative to the shard directory so the shard can be
+    moved or copied to another host before merging.
+    """
+    def relative(path):
+        return os.path.relpath(path, output_dir)
+
+    files = shard_info['generated_files']
+    by_index = {}
+    for kind in ('html', 'json', 'pdf'):
+        for path in files[kind]:
+            index = int(Path(path).stem)
+            by_index.setdefault(index, {'index': index})[kind] = relative(path)
+
+    manifest = {key: value for key, value in shard_info.items() if key != 'generated_files'}
+    manifest['mapping_file'] = relative(shard_info['mapping_file'])
+    manifest['variants'] = [by_index[index] for index in sorted(by_index)]
+
+    manifest_file = os.path.join(output_dir, 'manifest.json')
+    with open(manifest_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest_file
+
+
+def read_mapping_rows(mapping_file):
+    """Read the rows of a cash_flow_mapping.csv file"""
+    with open(mapping_file, newline='', encoding='utf-8') as csvfile:
+        return list(csv.DictReader(csvfile))
+
+
+def merge_shard_manifests(manifest_files, index_file='corpus_index.json'):
+    """
+    Combine shard manifests and their cash-flow mappings into one corpus index.
+
+    Args:
+        manifest_files (list): Paths of the shards' manifest.json files
+        index_file (str): Path of the merged corpus index (default: 'corpus_index.json')
+
+    Returns:
+        dict: The corpus index that was written
+    """
+    index_dir = os.path.dirname(os.path.abspath(index_file))
+    variants = {}
+    shards = []
+    mapping = None
+    corpus = None
+    input_file = None
+
+    for manifest_file in manifest_files:
+        with open(manifest_file, encoding='utf-8') as f:
+            manifest = json.load(f)
+        shard_dir = os.path.dirname(os.path.abspath(manifest_file))
+
+        # Every shard must come from the same corpus definition; the input is
+        # compared by content since each node may store it at its own path
+        shard_corpus = (manifest['input_sha256'], manifest['seed'], manifest['total_variants'], manifest['shard'][1])
+        if corpus is None:
+            corpus = shard_corpus
+            input_file = manifest['input_file']
+        elif shard_corpus != corpus:
+            raise ValueError(f"{manifest_file} belongs to a different corpus: {shard_corpus} != {corpus}")
+
+        shard_mapping = read_mapping_rows(os.path.join(shard_dir, manifest['mapping_file']))
+        if mapping is None:
+            mapping = shard_mapping
+        elif shard_mapping != mapping:
+            raise ValueError(f"{manifest_file} has a different cash flow mapping")
+
+        for variant in manifest['variants']:
+            if variant['index'] in variants:
+                raise ValueError(f"Variant {variant['index']} appears in more than one shard")
+            variants[variant['index']] = {
+                key: value if key == 'index' else os.path.relpath(os.path.join(shard_dir, value), index_dir)
+                for key, value in variant.items()
+            }
+        shards.append(manifest['shard'])
+
+    input_sha256, seed, total_variants, shard_count = corpus if corpus else (None, None, 0, 0)
+    missing_shards = sorted(set(range(1, shard_count + 1)) - {shard_index for shard_index, _ in shards})
+    corpus_index = {
+        'input_file': input_file,
+        'input_sha256': input_sha256,
+        'seed': seed,
+        'total_variants': total_variants,
+        'shards': sorted(shards),
+        'missing_shards': missing_shards,
+        'mapping': mapping or [],
+        'variants': [variants[index] for index in sorted(variants)]
     }
+    with open(index_file, 'w', encoding='utf-8') as f:
+        json.dump(corpus_index, f, indent=2)
+
+    print(f"Merged {len(shards)} shard manifests ({len(variants)} variants) into {index_file}")
+    if missing_shards:
+        print(f"Missing shards: {missing_shards}")
+    return corpus_index
+
+
+def parse_shard(text):
+    """Parse a shard spec such as '2/8' into (2, 8)"""
+    try:
+        shard_index, shard_count = (int(part) for part in text.split('/'))
+        shard_range(0, shard_index, shard_count)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/n with 1 <= i <= n, got '{text}'")
+    return shard_index, shard_count
 
 
 if __name__ == '__main__':
-    # For backward compatibility - run with default parameters
-    result = scramble_financial_data()
-    print(f"\nSummary: Generated {result['files_generated']} sets of files")
+    parser = argparse.ArgumentParser(description="Scramble financial data in an XBRL HTML file")
+    parser.add_argument('--count', type=int, default=10, help="Variants in the whole corpus (default: 10)")
+    parser.add_argument('--input', default='aapl_p33.html', help="Input HTML file (default: aapl_p33.html)")
+    parser.add_argument('--seed', type=int, default=None, help="Seed for reproducible output")
+    parser.add_argument('--pdf-workers', type=int, default=1, help="Processes rendering PDFs (default: 1)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Processes generating variants (and their PDFs) from a shared template (default: 1)")
+    parser.add_argument('--no-html', action='store_true', help="Don't write html_out files")
+    parser.add_argument('--no-pdf', action='store_true', help="Don't render pdf_out files (skips loading WeasyPrint)")
+    parser.add_argument('--pdf-mode', choices=['full', 'layout'], default='full',
+                        help="'layout' lays the statement out once and patches numbers into each PDF (default: full)")
+    parser.add_argument('--verify-layout', type=int, default=1, metavar='N',
+                        help="With --pdf-mode layout, check N PDFs spread over the run against a full render (default: 1)")
+    parser.add_argument('--no-minimize', action='store_true',
+                        help="Render PDFs from the full document instead of the minimized template")
+    parser.add_argument('--stylesheet-diagnostics', action='store_true',
+                        help="List unsupported and costly PDF stylesheet selectors and their matching cost, then exit")
+    parser.add_argument('--no-template-cache', action='store_true',
+                        help=f"Always re-parse the input instead of using {TEMPLATE_CACHE_DIR}/")
+    parser.add_argument('--shard', type=parse_shard, default=None,
+                        help="Generate only shard i of n (e.g. 2/8) into shard_i_of_n/")
+    parser.add_argument('--output-dir', default=None, help="Directory for html_out/json_out/pdf_out")
+    parser.add_argument('--merge', nargs='+', metavar='MANIFEST',
+                        help="Merge shard manifest.json files into a corpus index instead of generating")
+    parser.add_argument('--index-file', default='corpus_index.json',
+                        help="Corpus index written by --merge (default: corpus_index.json)")
+    args = parser.parse_args()
+    if args.pdf_mode == 'layout' and args.pdf_workers > 1:
+        parser.error("--pdf-mode layout does not use --pdf-workers; use --workers")
+    if args.pdf_mode == 'layout' and args.no_minimize:
+        parser.error("--pdf-mode layout always patches the minimized template; drop --no-minimize")
+
+    if args.merge:
+        merge_shard_manifests(args.merge, args.index_file)
+    elif args.stylesheet_diagnostics:
+        print_stylesheet_diagnostics(args.input, None if args.no_template_cache else TEMPLATE_CACHE_DIR)
+    else:
+        # With no arguments this runs with the default parameters, as before
+        result = scramble_financial_data(generate_file_count=args.count, input_file=args.input,
+                                         pdf_workers=args.pdf_workers, write_html=not args.no_html,
+                                         seed=args.seed, shard=args.shard, output_dir=args.output_dir,
+                                         write_pdf=not args.no_pdf,
+                                         template_cache=None if args.no_template_cache else TEMPLATE_CACHE_DIR,
+                                         generate_workers=args.workers, pdf_mode=args.pdf_mode,
+                                         verify_layout=args.verify_layout, minimize_pdf=not args.no_minimize)
+        print(f"\nSummary: Generated {result['files_generated']} sets of files")